@@ -5,6 +5,9 @@ SECTION_NAME = "CallDB"
 DXL_DIR = "target_dxl"
 TITLE_COLUMN = "DocumentNo"  # ページタイトルに使う列名
 SLEEP_SEC = 0.2  # 連続POSTの間隔（429回避用、必要なら増やす）
+ID_CACHE_TTL_SEC = 3600  # ノートブック/セクションIDをDXL_DIR内にキャッシュする秒数（0でキャッシュしない）
+UPLOAD_WORKERS = 1  # 同時にPOSTするページ数（2以上で並列。ページの作成順は入力順にならない）
+PATCH_WORKERS = 1  # 1ページの6個目以降の画像/添付を送る PATCH の同時数（2以上で並列）
 
 # RichText（画像 / リンク / 表などを拾う可能性のあるフィールド）
 # タスク：動的にする
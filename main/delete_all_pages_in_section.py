@@ -1,38 +1,140 @@
+import logging
 import time
+from typing import Optional
 from urllib.parse import quote
 
+import requests
+
 from main.services.graph_client import GraphClient
+from main.services.graph_throttle import AdaptiveTokenBucket
 
-def delete_all_pages_in_section(
-    client: GraphClient,
-    section_id: str,
-    sleep_sec: float = 0.2,
-) -> int:
+logger = logging.getLogger(__name__)
+
+GRAPH_BATCH_URL = "/$batch"
+BATCH_SIZE = 20  # Graph JSON batching の1リクエストあたり上限
+MAX_PAGE_SIZE = 100  # OneNote の pages 一覧の $top 上限（これを超えると 400）
+BATCH_RATE = 5.0  # $batch 送信レートの初期値（件/秒、従来の0.2秒間隔相当）。以後は 429/503 の有無で自動調整する
+
+
+def _list_page_ids(client: GraphClient, section_id: str, *, page_size: int = MAX_PAGE_SIZE) -> list[str]:
+    """
+    セクション内の全ページIDを取得する（$select=id でレスポンスを最小限にする）。
+    ※ 削除しながらページングすると nextLink（$skip）がずれて取りこぼすため、先に全件集める
+    ※ nextLink は前のレスポンスが来ないと分からないので、次ページの先読みはできない
+    """
+    top = max(1, min(page_size, MAX_PAGE_SIZE))
     url = (
-        f"https://graph.microsoft.com/v1.0/me/onenote/sections/{quote(section_id)}/pages"
-        f"?$select=id,title&$top=100"
+        f"/me/onenote/sections/{quote(section_id)}/pages"
+        f"?$select=id&$top={top}"
     )
 
-    deleted = 0
+    page_ids: list[str] = []
     while url:
         data = client.get_json(url)
-        pages = data.get("value", [])
-
-        for p in pages:
+        for p in data.get("value", []):
             page_id = p.get("id")
-            title = p.get("title", "")
-            if not page_id:
-                continue
+            if page_id:
+                page_ids.append(page_id)
 
-            del_url = f"https://graph.microsoft.com/v1.0/me/onenote/pages/{quote(page_id)}"
-            client.delete(del_url)
+        url = data.get("@odata.nextLink")
 
-            deleted += 1
-            print(f"[DEL] {deleted}: {title} ({page_id})")
+    return page_ids
 
-            if sleep_sec:
-                time.sleep(sleep_sec)
 
-        url = data.get("@odata.nextLink")
+def _delete_batch(client: GraphClient, page_ids: list[str]) -> tuple[list[str], Optional[float]]:
+    """
+    最大20ページを $batch で一括削除する。
+    戻り値: (429/503/5xx で再試行が必要なページ, サブレスポンスの Retry-After の最大（無ければNone）)
+    - 404 は削除済みとみなす（再実行や他からの削除で既に無いページ）
+    - サブレスポンスが返ってこなかったページも、削除できたか分からないので再試行に回す
+    - 401/403 などその他の 4xx は再試行しても直らないので例外にする
+    """
+    body = {
+        "requests": [
+            {"id": str(i), "method": "DELETE", "url": f"/me/onenote/pages/{quote(page_id)}"}
+            for i, page_id in enumerate(page_ids)
+        ]
+    }
+    data = client.post_json(GRAPH_BATCH_URL, body)
+
+    policy = client.retry_policy
+    retry: list[str] = []
+    retry_after: Optional[float] = None
+    answered: set[int] = set()
+    for res in data.get("responses", []):
+        idx = int(res["id"])
+        answered.add(idx)
+        page_id = page_ids[idx]
+        status = int(res.get("status", 0))
+
+        if status in policy.retry_statuses or status >= 500:
+            headers = res.get("headers") or {}
+            retry.append(page_id)
+            value = headers.get("Retry-After")
+            if value is not None:
+                retry_after = float(value) if retry_after is None else max(retry_after, float(value))
+            continue
+
+        if status == 404:
+            continue
+
+        if status >= 400:
+            raise RuntimeError(f"DELETE failed in $batch: status={status} page_id={page_id} body={res.get('body')}")
+
+    missing = [page_ids[i] for i in range(len(page_ids)) if i not in answered]
+    if missing:
+        logger.warning("$batch returned no response for %s pages. retrying", len(missing))
+        retry.extend(missing)
+
+    return retry, retry_after
+
+
+def delete_all_pages_in_section(
+    client: GraphClient,
+    section_id: str,
+) -> int:
+    """
+    セクション内の全ページを $batch（20件ずつ）で削除する。
+    - 送信ペースはトークンバケットで調整する（成功で少しずつ上げ、429/503 で半分に下げる）
+    - 429/503 になった分は Retry-After を守って再送する
+    """
+    page_ids = _list_page_ids(client, section_id)
+    bucket = AdaptiveTokenBucket(BATCH_RATE)
+
+    deleted = 0
+    for off in range(0, len(page_ids), BATCH_SIZE):
+        chunk = page_ids[off : off + BATCH_SIZE]
+
+        # 429/503/5xx・通信エラーになった分は Retry-After（無ければバックオフ、+ジッター）だけ待って再送する
+        wait = 0.0
+        max_retries = max(1, client.retry_policy.max_retries)
+        for attempt in range(1, max_retries + 1):
+            bucket.acquire()
+            try:
+                retry, retry_after = _delete_batch(client, chunk)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 通信エラーは一時的なものとして、このまとまりごと再送する
+                logger.warning("$batch delete failed (%s). retrying %s pages", e, len(chunk))
+                retry, retry_after = chunk, None
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code < 500:
+                    raise
+                logger.warning("$batch delete failed (status=%s). retrying %s pages", e.response.status_code, len(chunk))
+                retry, retry_after = chunk, None
+
+            done = len(chunk) - len(retry)
+            deleted += done
+            print(f"[DEL] {deleted}/{len(page_ids)} (+{done})")
+
+            if not retry:
+                bucket.on_success()
+                break
+            bucket.on_throttle()
+            chunk = retry
+            if attempt == max_retries:
+                # 最後の試行の後は待たずに失敗にする
+                raise RuntimeError(f"DELETE failed after retries: {len(chunk)} pages left")
+            wait = client.retry_policy.next_wait(retry_after, wait)
+            time.sleep(wait)
 
     return deleted
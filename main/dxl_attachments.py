@@ -1,16 +1,35 @@
 # dxl_attachments.py
 from __future__ import annotations
 
-import base64
+import binascii
 import mimetypes
-import re
+import threading
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from typing import Iterable
 
 from lxml import etree
 
 
+_NS = {"d": "http://www.lotus.com/dxl"}
+
+# 繰り返し使う XPath（モジュール読込時に1回だけコンパイル）
+_FILE_ITEMS = etree.XPath(".//d:item[@name='$FILE']", namespaces=_NS)
+_FILE = etree.XPath(".//d:file", namespaces=_NS)
+_FILEDATA = etree.XPath(".//d:filedata", namespaces=_NS)
+
+# パーサはファイルごとに作らず使い回す（lxml のパーサは同時に1スレッドでしか使えないのでスレッドごとに持つ）
+_PARSER_TLS = threading.local()
+
+
+def _parser() -> etree.XMLParser:
+    parser = getattr(_PARSER_TLS, "parser", None)
+    if parser is None:
+        parser = _PARSER_TLS.parser = etree.XMLParser(recover=True, huge_tree=True, collect_ids=False)
+    return parser
+
+
 @dataclass
 class DxlAttachment:
     filename: str
@@ -18,44 +37,65 @@ class DxlAttachment:
     content: bytes
 
 
-def _guess_mime(filename: str) -> str:
-    mime, _ = mimetypes.guess_type(filename)
+@lru_cache(maxsize=None)
+def _mime_for_ext(ext: str) -> str:
+    """拡張子（小文字・ドット無し）→ MIME。拡張子の種類は少ないのでキャッシュする。"""
+    mime, _ = mimetypes.guess_type(f"x.{ext}")
     if mime:
         return mime
-    fn = filename.lower()
-    if fn.endswith(".xlsx"):
+    if ext == "xlsx":
         return "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    if fn.endswith(".xls"):
+    if ext == "xls":
         return "application/vnd.ms-excel"
-    if fn.endswith(".pdf"):
+    if ext == "pdf":
         return "application/pdf"
     return "application/octet-stream"
 
 
+def _guess_mime(filename: str) -> str:
+    if "." not in filename:
+        return "application/octet-stream"
+    return _mime_for_ext(filename.rsplit(".", 1)[-1].lower())
+
+
+def decode_base64_text(text: str) -> bytes:
+    """
+    DXLに埋め込まれたbase64文字列をバイナリに戻す。
+    - binascii.a2b_base64 は改行/空白をC側で読み飛ばすため、事前の空白除去（正規表現）は不要
+    """
+    return binascii.a2b_base64(text)
+
+
 def extract_attachments_from_dxl(dxl_path: str | Path) -> list[DxlAttachment]:
     dxl_path = Path(dxl_path)
-    parser = etree.XMLParser(recover=True, huge_tree=True)
-    root = etree.parse(str(dxl_path), parser).getroot()
-
-    ns = {"d": "http://www.lotus.com/dxl"}
-    items = root.xpath(".//d:item[@name='$FILE']", namespaces=ns)
+    root = etree.parse(str(dxl_path), _parser()).getroot()
 
     out: list[DxlAttachment] = []
-    for it in items:
-        f = it.find(".//{http://www.lotus.com/dxl}file")
-        fd = it.find(".//{http://www.lotus.com/dxl}filedata")
-        if f is None or fd is None:
-            continue
-
-        filename = f.get("name") or "attachment.bin"
-        b64 = re.sub(r"\s+", "", "".join(fd.itertext()))
-        content = base64.b64decode(b64)  # xlsxなら先頭が b'PK\x03\x04' になる
-
-        out.append(
-            DxlAttachment(
-                filename=filename,
-                mime=_guess_mime(filename),
-                content=content,
-            )
-        )
+    for it in _FILE_ITEMS(root):
+        a = attachment_from_file_item(it)
+        if a is not None:
+            out.append(a)
     return out
+
+
+def attachment_from_file_item(item: etree._Element) -> DxlAttachment | None:
+    """
+    $FILE の item 1件から添付ファイル（名前・MIME・実体）を取り出す。
+    iterparse で item ごとに処理する場合もこれを使う。
+    """
+    files = _FILE(item)
+    filedatas = _FILEDATA(item)
+    if not files or not filedatas:
+        return None
+    f, fd = files[0], filedatas[0]
+
+    filename = f.get("name") or "attachment.bin"
+    # filedata の中身は通常テキスト1つだけなので、そのまま渡す（文字列を組み立て直さない）
+    b64 = fd.text if len(fd) == 0 else "".join(fd.itertext())
+    content = decode_base64_text(b64 or "")  # xlsxなら先頭が b'PK\x03\x04' になる
+
+    return DxlAttachment(
+        filename=filename,
+        mime=_guess_mime(filename),
+        content=content,
+    )
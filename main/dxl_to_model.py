@@ -2,81 +2,110 @@
 from __future__ import annotations
 
 import re
-import xml.etree.ElementTree as ET
 from dataclasses import fields
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from lxml import etree
 
 from main.models.models import OneNoteRow
 
 DXL_NS = {"dxl": "http://www.lotus.com/dxl"}
+_ITEM_TAG = "{http://www.lotus.com/dxl}item"
+
+# item ごとに使う XPath（モジュール読込時に1回だけコンパイル）
+_RICHTEXT = etree.XPath("./dxl:richtext", namespaces=DXL_NS)
+_TEXTS = etree.XPath(".//dxl:text", namespaces=DXL_NS)
+_NUMBERS = etree.XPath(".//dxl:number", namespaces=DXL_NS)
+_DATETIMES = etree.XPath(".//dxl:datetime", namespaces=DXL_NS)
+_FILES = etree.XPath(".//dxl:file", namespaces=DXL_NS)
+_DOCLINKS = etree.XPath(".//dxl:doclink", namespaces=DXL_NS)
+
+# OneNoteRow が持つフィールド名セット（extra/attachments/notes_links含む）。DXLごとに作り直さない
+_ROW_FIELD_NAMES = frozenset(f.name for f in fields(OneNoteRow))
+
+# text 値の空白正規化用
+_WS = re.compile(r"[ \t]+")
+
+
+def _squeeze_ws(v: str) -> str:
+    # 単独スペースの置換は結果が変わらないので、連続空白/タブがある値だけ正規表現にかける
+    if "\t" in v or "  " in v:
+        return _WS.sub(" ", v)
+    return v
 
 
 def _join_clean(values: List[str]) -> str:
     """複数値を 1 文字列にまとめる（空は落として、改行で結合）。"""
-    vals = [v.strip() for v in values if (v or "").strip()]
     # 空白が多すぎると見づらいので軽く正規化（必要なら外してOK）
-    vals = [re.sub(r"[ \t]+", " ", v) for v in vals]
-    return "\n".join(vals)
+    return "\n".join(_squeeze_ws(s) for s in (v.strip() for v in values if v) if s)
 
 
-def _extract_item_as_str(item: ET.Element) -> Optional[str]:
+def _join_values(values: List[str]) -> str:
+    """number/datetime 用（値に空白の連続は無いので正規化はしない）。"""
+    return "\n".join(s for s in (v.strip() for v in values) if s)
+
+
+def _text_of(el: etree._Element) -> str:
+    """要素配下のテキストを連結して返す（lxml の C 実装でまとめて取り出す）。"""
+    return etree.tostring(el, method="text", encoding="unicode", with_tail=False)
+
+
+def _extract_item_as_str(item: etree._Element) -> Optional[str]:
     """
     <item> から「人間が読める文字列」を抜く。
     - text / number / datetime を優先
-    - richtext は itertext() でテキスト化
+    - richtext はタグを除いたテキストにする
     """
     # richtext
-    rich = item.find("./dxl:richtext", DXL_NS)
-    if rich is not None:
-        txt = "".join(rich.itertext()).strip()
+    rich = _RICHTEXT(item)
+    if rich:
+        txt = _text_of(rich[0]).strip()
         return txt or None
 
     # text
-    texts = [t.text or "" for t in item.findall(".//dxl:text", DXL_NS)]
+    texts = [t.text or "" for t in _TEXTS(item)]
     if texts:
         s = _join_clean(texts)
         return s or None
 
     # number
-    nums = [n.text or "" for n in item.findall(".//dxl:number", DXL_NS)]
+    nums = [n.text or "" for n in _NUMBERS(item)]
     if nums:
-        s = _join_clean(nums)
+        s = _join_values(nums)
         return s or None
 
-    # datetime（中身は要素により違うので itertext を全部結合）
-    dts = []
-    for dt in item.findall(".//dxl:datetime", DXL_NS):
-        dts.append("".join(dt.itertext()).strip())
+    # datetime（中身は要素により違うので配下のテキストを全部結合）
+    dts = [_text_of(dt) for dt in _DATETIMES(item)]
     if dts:
-        s = _join_clean(dts)
+        s = _join_values(dts)
         return s or None
 
     # fallback：item全体の文字（タグ除去済みのテキスト）
-    fallback = "".join(item.itertext()).strip()
+    fallback = _text_of(item).strip()
     return fallback or None
 
 
-def _extract_attachments(root: ET.Element) -> List[str]:
+def _extract_attachments(item: etree._Element) -> List[str]:
     """
-    $FILE から添付ファイル名だけ取り出す（実体はここでは扱わない）
+    $FILE の item から添付ファイル名だけ取り出す（実体はここでは扱わない）
     """
     names: List[str] = []
-    for item in root.findall(".//dxl:item[@name='$FILE']", DXL_NS):
-        for f in item.findall(".//dxl:file", DXL_NS):
-            nm = f.get("name") or ""
-            nm = nm.strip()
-            if nm:
-                names.append(nm)
+    for f in _FILES(item):
+        nm = f.get("name") or ""
+        nm = nm.strip()
+        if nm:
+            names.append(nm)
     return names
 
 
-def _extract_doclinks(root: ET.Element) -> List[str]:
+def _extract_doclinks(item: etree._Element) -> List[str]:
     """
     doclink を「置換しやすい仮リンク文字列」にする
     例: notesdoc:<ReplicaId>:<UNID> | <description>
     """
     links: List[str] = []
-    for dl in root.findall(".//dxl:doclink", DXL_NS):
+    for dl in _DOCLINKS(item):
         doc = (dl.get("document") or "").strip()
         db = (dl.get("database") or "").strip()
         desc = (dl.get("description") or "").strip()
@@ -94,60 +123,112 @@ def _extract_doclinks(root: ET.Element) -> List[str]:
     return links
 
 
-def dxl_to_onenote_row(dxl_path: str) -> OneNoteRow:
+def iter_dxl_items(dxl_path: str | Path) -> Iterator[etree._Element]:
     """
-    DXLファイル1件 → OneNoteRow（全部str）
+    DXLの <item> を文書順に1件ずつ返す（lxml の iterparse で逐次パース）。
+    - 呼び出し側の処理が終わった item は clear し、処理済みの兄弟要素も親から外す
+    - DOM全体を保持しないので、画像を多く含むDXLでもメモリは item 1件分で済む
+    """
+    context = etree.iterparse(
+        str(dxl_path),
+        events=("end",),
+        tag=_ITEM_TAG,
+        huge_tree=True,
+        recover=True,
+    )
+    for _, item in context:
+        yield item
+
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+    del context
+
+
+class OneNoteRowBuilder:
+    """
+    <item> を1件ずつ受け取り、OneNoteRow の生成に必要な値を溜めていく。
     - OneNoteRowに存在するフィールド名はそのままセット
     - 存在しないフィールドは extra に入れる
     - 添付名は attachments、doclinkは notes_links に入れる
     """
-    root = ET.parse(dxl_path).getroot()
 
-    # OneNoteRow が持つフィールド名セット（extra/attachments/notes_links含む）
-    model_field_names = {f.name for f in fields(OneNoteRow)}
+    def __init__(self) -> None:
+        # OneNoteRowに渡すkwargs
+        self._kwargs: Dict[str, object] = {}
+        self._extra: Dict[str, str] = {}
+        self._attachments: List[str] = []
+        self._notes_links: List[str] = []
 
-    # OneNoteRowに渡すkwargs
-    kwargs: Dict[str, object] = {}
+        # 呼び出し側で作った値（RichTextのHTMLなど）。build時に抽出値より優先する
+        self._overrides: Dict[str, object] = {}
 
-    extra: Dict[str, str] = {}
+    def add_item(self, item: etree._Element, *, extract_value: bool = True) -> None:
+        """
+        item 1件分の値を溜める。
+        extract_value=False の場合は doclink だけ拾う（値を set_field で差し替えるフィールド用）
+        """
+        # doclink は richtext 内に出現するので、item ごとに拾っておく
+        self._notes_links.extend(_extract_doclinks(item))
 
-    # item を全部走査
-    for item in root.findall(".//dxl:item", DXL_NS):
         name = item.get("name")
-        if not name:
-            continue
+        if not name or not extract_value:
+            return
 
-        # 添付は別枠で処理するのでここではスキップ
+        # 添付は別枠で処理する（ここではファイル名だけ拾う）
         if name == "$FILE":
-            continue
+            self._attachments.extend(_extract_attachments(item))
+            return
 
         v = _extract_item_as_str(item)
         if v is None:
-            continue
+            return
 
-        if name in model_field_names:
+        if name in _ROW_FIELD_NAMES:
             # 既に値が入っている場合（同名itemが複数）→改行追記
-            prev = kwargs.get(name)
+            prev = self._kwargs.get(name)
             if isinstance(prev, str) and prev.strip():
-                kwargs[name] = prev + "\n" + v
+                self._kwargs[name] = prev + "\n" + v
             else:
-                kwargs[name] = v
+                self._kwargs[name] = v
         else:
             # モデル未定義は extra へ
+            extra = self._extra
             if name in extra and extra[name].strip():
                 extra[name] = extra[name] + "\n" + v
             else:
                 extra[name] = v
 
-    # extra / 添付 / doclink を詰める
-    if "extra" in model_field_names:
-        kwargs["extra"] = extra
+    def set_field(self, name: str, value: object) -> None:
+        """抽出値の代わりに使う値をセットする（OneNoteRowの生成は build で1回だけ）。"""
+        self._overrides[name] = value
+
+    def build(self) -> OneNoteRow:
+        kwargs = dict(self._kwargs)
+
+        # extra / 添付 / doclink を詰める
+        if "extra" in _ROW_FIELD_NAMES:
+            kwargs["extra"] = self._extra
+
+        if "attachments" in _ROW_FIELD_NAMES:
+            kwargs["attachments"] = self._attachments
+
+        if "notes_links" in _ROW_FIELD_NAMES:
+            kwargs["notes_links"] = self._notes_links
 
-    if "attachments" in model_field_names:
-        kwargs["attachments"] = _extract_attachments(root)
+        kwargs.update(self._overrides)
 
-    if "notes_links" in model_field_names:
-        kwargs["notes_links"] = _extract_doclinks(root)
+        # コンストラクタで一発生成
+        return OneNoteRow(**kwargs)  # type: ignore[arg-type]
 
-    # frozen dataclass なのでコンストラクタで一発生成
-    return OneNoteRow(**kwargs)  # type: ignore[arg-type]
+
+def dxl_to_onenote_row(dxl_path: str) -> OneNoteRow:
+    """
+    DXLファイル1件 → OneNoteRow（全部str）
+    ※ RichText のHTML化も同じ走査で行いたい場合は
+      iter_dxl_items() + OneNoteRowBuilder を直接使う
+    """
+    builder = OneNoteRowBuilder()
+    for item in iter_dxl_items(dxl_path):
+        builder.add_item(item)
+    return builder.build()
@@ -1,15 +1,33 @@
 # find_id.py
+import json
+import logging
+import time
+from functools import lru_cache
+from pathlib import Path
 from urllib.parse import quote
 
 from main.services.graph_client import GraphClient
 
+logger = logging.getLogger(__name__)
 
+
+def _odata_literal(value: str) -> str:
+    """
+    $filter に埋め込む文字列リテラル（'...'）を作る。
+    - OData の規則で ' は '' にする
+    - 名前に & や # が含まれてもクエリが壊れないよう、URLエンコードまで1回で行う
+    """
+    return "'" + quote(value.replace("'", "''"), safe="") + "'"
+
+
+# IDは実行中に変わらないので、同じ client（=同じトークン）・名前の問い合わせはキャッシュする
+# （見つからない/曖昧で例外になった場合はキャッシュされない）
+@lru_cache(maxsize=128)
 def find_notebook_id(client: GraphClient, notebook_name: str) -> str:
     """表示名からノートブックIDを取得する。"""
-    safe = notebook_name.replace("'", "''")
     url = (
-        "https://graph.microsoft.com/v1.0/me/onenote/notebooks"
-        f"?$filter=displayName eq '{safe}'&$select=id,displayName"
+        "/me/onenote/notebooks"
+        f"?$filter=displayName eq {_odata_literal(notebook_name)}&$select=id,displayName"
     )
     data = client.get_json(url)
     items = data.get("value", [])
@@ -20,12 +38,12 @@ def find_notebook_id(client: GraphClient, notebook_name: str) -> str:
     return items[0]["id"]
 
 
+@lru_cache(maxsize=128)
 def find_section_id(client: GraphClient, notebook_id: str, section_name: str) -> str:
     """表示名からセクションIDを取得する。"""
-    safe = section_name.replace("'", "''")
     url = (
-        f"https://graph.microsoft.com/v1.0/me/onenote/notebooks/{quote(notebook_id)}/sections"
-        f"?$filter=displayName eq '{safe}'&$select=id,displayName"
+        f"/me/onenote/notebooks/{quote(notebook_id)}/sections"
+        f"?$filter=displayName eq {_odata_literal(section_name)}&$select=id,displayName"
     )
     data = client.get_json(url)
     items = data.get("value", [])
@@ -34,3 +52,102 @@ def find_section_id(client: GraphClient, notebook_id: str, section_name: str) ->
     if len(items) > 1:
         raise RuntimeError(f"Section name is ambiguous (multiple found): {section_name}")
     return items[0]["id"]
+
+
+@lru_cache(maxsize=128)
+def find_notebook_and_section_ids(client: GraphClient, notebook_name: str, section_name: str) -> tuple[str, str]:
+    """
+    表示名からノートブックIDとセクションIDを1回のリクエストで取得する。
+    - ノートブックの検索時に $expand=sections でセクション一覧も一緒に受け取る（往復を1回減らす）
+    - セクション名の絞り込みは受け取った一覧から行う
+    """
+    url = (
+        "/me/onenote/notebooks"
+        f"?$filter=displayName eq {_odata_literal(notebook_name)}&$select=id,displayName"
+        "&$expand=sections($select=id,displayName)"
+    )
+    data = client.get_json(url)
+    items = data.get("value", [])
+    if not items:
+        raise RuntimeError(f"Notebook not found: {notebook_name}")
+    if len(items) > 1:
+        raise RuntimeError(f"Notebook name is ambiguous (multiple found): {notebook_name}")
+    notebook = items[0]
+
+    sections = [s for s in notebook.get("sections", []) if s.get("displayName") == section_name]
+    if not sections:
+        raise RuntimeError(f"Section not found in notebook: {section_name}")
+    if len(sections) > 1:
+        raise RuntimeError(f"Section name is ambiguous (multiple found): {section_name}")
+    return notebook["id"], sections[0]["id"]
+
+
+# ==============================
+# 実行をまたいだIDキャッシュ（JSONファイル）
+# ==============================
+#
+# ファイルの形式:
+#   {"<ノートブック名>": {"<セクション名>": {"notebook_id": ..., "section_id": ..., "expires": <epoch秒>}}}
+
+def _read_id_cache(cache_path: Path) -> dict:
+    try:
+        data = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_id_cache(cache_path: Path, cache: dict) -> None:
+    # 書き込みに失敗しても本処理は続けられるので、警告だけにする
+    try:
+        tmp = cache_path.with_name(cache_path.name + ".tmp")
+        tmp.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(cache_path)
+    except OSError as e:
+        logger.warning("Failed to write id cache: %s (%s)", cache_path, e)
+
+
+def find_notebook_and_section_ids_cached(
+    client: GraphClient,
+    notebook_name: str,
+    section_name: str,
+    *,
+    cache_path: Path,
+    ttl_sec: float,
+) -> tuple[str, str]:
+    """
+    find_notebook_and_section_ids の結果を cache_path に保存し、ttl_sec 秒の間は再利用する。
+    - 期限切れ/未登録/ファイル破損のときだけ Graph に問い合わせる
+    - ttl_sec <= 0 ならキャッシュを使わない
+    """
+    if ttl_sec <= 0:
+        return find_notebook_and_section_ids(client, notebook_name, section_name)
+
+    cache = _read_id_cache(cache_path)
+    sections = cache.get(notebook_name)
+    entry = sections.get(section_name) if isinstance(sections, dict) else None
+    # 値の型がおかしい（手で編集された等）エントリは破損扱いにして問い合わせ直す
+    expires = entry.get("expires") if isinstance(entry, dict) else None
+    if isinstance(expires, (int, float)) and expires > time.time():
+        cached_ids = (entry.get("notebook_id"), entry.get("section_id"))
+        if all(isinstance(v, str) for v in cached_ids):
+            return cached_ids
+
+    notebook_id, section_id = find_notebook_and_section_ids(client, notebook_name, section_name)
+    if not isinstance(sections, dict):
+        sections = cache[notebook_name] = {}
+    sections[section_name] = {
+        "notebook_id": notebook_id,
+        "section_id": section_id,
+        "expires": time.time() + ttl_sec,
+    }
+    _write_id_cache(cache_path, cache)
+    return notebook_id, section_id
+
+
+def forget_cached_ids(cache_path: Path, notebook_name: str, section_name: str) -> None:
+    """キャッシュ済みIDを破棄する（セクション削除などで 404 になったとき用）。"""
+    cache = _read_id_cache(cache_path)
+    sections = cache.get(notebook_name)
+    if isinstance(sections, dict) and sections.pop(section_name, None) is not None:
+        _write_id_cache(cache_path, cache)
@@ -1,49 +1,89 @@
 from __future__ import annotations
 
 import json
+import os
+from pathlib import Path
 from typing import Any, Dict, Mapping, Optional
 
 
 REDACTED = "***REDACTED***"
 
+# 必ず秘匿するヘッダー名（小文字）
+_SENSITIVE_HEADERS = frozenset({"authorization", "cookie", "set-cookie", "x-authorization"})
+
 
 def mask_headers(headers: Mapping[str, str]) -> Dict[str, str]:
     """
     ヘッダーをログ出力するためにマスクする。
     - Authorization / Cookie などは必ず秘匿する。
     """
-    masked = dict(headers)
+    return {k: (REDACTED if k.lower() in _SENSITIVE_HEADERS else v) for k, v in headers.items()}
 
-    for k in list(masked.keys()):
-        lk = k.lower()
-        if lk in ("authorization", "cookie", "set-cookie", "x-authorization"):
-            masked[k] = REDACTED
 
-    return masked
+def _utf8_prefix(text: str, limit: int) -> str:
+    """UTF-8 で limit バイト以内に収まる先頭部分（文字の途中では切らない）。"""
+    # 1文字は1バイト以上なので、先頭 limit 文字だけエンコードすれば足りる
+    return text[:limit].encode("utf-8")[:limit].decode("utf-8", "ignore")
 
 
 def truncate_text(text: str, limit: int = 2000) -> str:
-    """ログ肥大化防止のための切り詰め。"""
+    """
+    ログ肥大化防止のための切り詰め（limit は UTF-8 のバイト数）。
+    - 1文字は最大4バイトなので、明らかに収まる長さならエンコードしない
+    """
     if text is None:
         return ""
-    if len(text) <= limit:
+    if len(text) * 4 <= limit:
         return text
-    return text[:limit] + f"...(truncated {len(text) - limit} chars)"
+    kept = _utf8_prefix(text, limit)
+    if len(kept) == len(text):
+        return text
+    return kept + f"...(truncated {len(text) - len(kept)} chars)"
 
 
 def safe_json_preview(obj: Any, limit: int = 2000) -> str:
     """
     JSON（dict/list等）をログ用に短く整形する。
+    - iterencode で少しずつ文字列化し、limit を超えた時点でやめる（巨大なdictを全部シリアライズしない）
     """
     if obj is None:
         return ""
     try:
-        s = json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
-        return truncate_text(s, limit=limit)
+        encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+        chunks: list[str] = []
+        size = 0
+        for chunk in encoder.iterencode(obj):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                # 全体の長さは分からないので、切ったことだけ示す
+                return _utf8_prefix("".join(chunks), limit) + "...(truncated)"
+        return truncate_text("".join(chunks), limit=limit)
     except Exception:
         return truncate_text(str(obj), limit=limit)
 
 
+def _content_size(content: Any) -> Optional[int]:
+    """multipart パートの中身のバイト数（中身は読まない。分からなければ None）。"""
+    if isinstance(content, memoryview):
+        return content.nbytes
+    if isinstance(content, (bytes, bytearray, str)):
+        # 文字列は危険なので長さだけ
+        return len(content)
+    if isinstance(content, Path):
+        try:
+            return content.stat().st_size
+        except OSError:
+            return None
+    if hasattr(content, "fileno"):
+        # 実ファイルなら fstat で残りサイズを出す（読み出し位置は動かさない）
+        try:
+            return os.fstat(content.fileno()).st_size - content.tell()
+        except (OSError, ValueError, AttributeError):
+            return None
+    return None
+
+
 def summarize_multipart_files(files: Any) -> list[dict]:
     """
     requests の files（multipart）を“中身無し”で要約する。
@@ -62,27 +102,14 @@ def summarize_multipart_files(files: Any) -> list[dict]:
 
     for name, value in items:
         try:
-            # value: (filename, content, content_type) を想定
-            filename = value[0] if len(value) > 0 else None
-            content = value[1] if len(value) > 1 else None
-            content_type = value[2] if len(value) > 2 else None
-
-            size = None
-            if isinstance(content, (bytes, bytearray)):
-                size = len(content)
-            elif hasattr(content, "read"):
-                # file-like はサイズ不明（読み出してはいけない）
-                size = None
-            elif isinstance(content, str):
-                # 文字列は危険なので長さだけ
-                size = len(content)
-
+            # value: (filename, content, content_type) を想定（足りない要素は None）
+            filename, content, content_type = (*value, None, None, None)[:3]
             out.append(
                 {
                     "part": str(name),
-                    "filename": str(filename) if filename is not None else None,
-                    "content_type": str(content_type) if content_type is not None else None,
-                    "size": size,
+                    "filename": None if filename is None else str(filename),
+                    "content_type": None if content_type is None else str(content_type),
+                    "size": _content_size(content),
                 }
             )
         except Exception:
@@ -107,6 +134,9 @@ def summarize_request_kwargs(request_kwargs: Dict[str, Any]) -> Dict[str, Any]:
         data = request_kwargs["data"]
         if isinstance(data, (bytes, bytearray)):
             summary["data_bytes"] = len(data)
+        elif hasattr(data, "parts"):
+            # MultipartBody（ストリーム）はパート定義から要約する
+            summary["multipart_parts"] = summarize_multipart_files(data.parts)
         else:
             summary["data_preview"] = truncate_text(str(data), limit=500)
 
@@ -1,11 +1,20 @@
 from __future__ import annotations
 
+import atexit
 import logging
+import multiprocessing
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 from typing import Optional
 
+# setup_logging で作った出力先（ワーカープロセスのログもここへ流す）
+_output_handlers: tuple[logging.Handler, ...] = ()
+_worker_queue: Optional[multiprocessing.Queue] = None
+_worker_queue_lock = threading.Lock()
+
 
 def setup_logging(
     *,
@@ -20,6 +29,8 @@ def setup_logging(
 
     - 既にハンドラが設定済みの場合は二重設定を避ける。
     - ログファイルはローテーションする（サイズ上限 + 世代数）。
+    - 出力は別スレッド（QueueListener）で行い、呼び出し側はキューに積むだけにする
+      （並列アップロード中にファイル書き込み/ローテーションで待たされない）。
     """
     root = logging.getLogger()
     if root.handlers:
@@ -47,6 +58,44 @@ def setup_logging(
     )
     fh.setFormatter(fmt)
 
+    # 終了時に listener.stop() でキューに残ったログを書き出してから止める
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, ch, fh, respect_handler_level=True)
+    listener.start()
+    global _output_handlers
+    _output_handlers = (ch, fh)
+    atexit.register(listener.stop)
+
     root.setLevel(getattr(logging, level.upper(), logging.INFO))
-    root.addHandler(ch)
-    root.addHandler(fh)
+    root.addHandler(QueueHandler(log_queue))
+
+
+def worker_logging_initargs() -> tuple[Optional[multiprocessing.Queue], int]:
+    """
+    ProcessPoolExecutor の initargs（init_worker_logging 用）を返す。
+
+    親の QueueHandler のキューは親プロセスのリスナーしか読まないので、
+    ワーカーのログはプロセス間キュー経由で親の出力先（コンソール/ファイル）へ流す。
+    """
+    global _worker_queue
+    with _worker_queue_lock:
+        if _worker_queue is None and _output_handlers:
+            _worker_queue = multiprocessing.Queue()
+            listener = QueueListener(_worker_queue, *_output_handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+    return _worker_queue, logging.getLogger().level
+
+
+def init_worker_logging(log_queue: Optional[multiprocessing.Queue], level: int) -> None:
+    """
+    ワーカープロセスの logging 設定（ProcessPoolExecutor の initializer）。
+    - fork で引き継いだ親のハンドラ（誰も読まないキュー）を外し、log_queue へ送るハンドラに付け替える
+    - log_queue が None（親で setup_logging していない）なら付け替えない
+    """
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    if log_queue is not None:
+        root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
@@ -1,8 +1,14 @@
 # main.py
 from __future__ import annotations
+import logging
+import os
 import time
 from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from dataclasses import dataclass
+from urllib.parse import quote
+
+import requests
 
 from main.ignore_git import token
 from main.config import (
@@ -11,14 +17,22 @@ from main.config import (
     DXL_DIR,
     TITLE_COLUMN,
     SLEEP_SEC,
+    UPLOAD_WORKERS,
+    PATCH_WORKERS,
+    ID_CACHE_TTL_SEC,
 )
-from main.find_id import find_notebook_id, find_section_id
+from main.find_id import find_notebook_and_section_ids_cached, forget_cached_ids
 from main.services.graph_client import GraphClient
 from main.logging.logging_config import setup_logging
-from main.services.page_payload_builder import build_page_payload
+from main.services.page_payload_builder import build_page_payloads
+from main.services.dxl_to_page_material import release_segment_files
+from main.services.upload_ledger import UploadLedger
+from main.models.models import PagePayload
 
 from .delete_all_pages_in_section import delete_all_pages_in_section
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass(frozen=True)
 class AppSettings:
@@ -29,6 +43,19 @@ class AppSettings:
     dxl_dir: Path
     title_column: str | None
     sleep_sec: float
+    upload_workers: int
+    patch_workers: int
+    id_cache_ttl_sec: float
+
+    @property
+    def id_cache_path(self) -> Path:
+        """ノートブック/セクションIDのキャッシュファイル（DXLファイル一覧には含まれない）。"""
+        return self.dxl_dir / ".onenote_ids.json"
+
+    @property
+    def ledger_path(self) -> Path:
+        """作成済みページの台帳ファイル（再実行時の重複作成防止用）。"""
+        return self.dxl_dir / ".uploaded_pages.jsonl"
 
 
 
@@ -76,60 +103,188 @@ def _load_settings() -> AppSettings:
         dxl_dir=dxl_dir,
         title_column=TITLE_COLUMN or None,
         sleep_sec=SLEEP_SEC,
+        upload_workers=max(1, int(UPLOAD_WORKERS)),
+        patch_workers=max(1, int(PATCH_WORKERS)),
+        id_cache_ttl_sec=float(ID_CACHE_TTL_SEC or 0),
     )
 
 
 def _load_dxl_files(dxl_dir: Path) -> list[Path]:
     """指定ディレクトリ内のDXLファイル一覧を取得する。"""
-    dxl_files = sorted(dxl_dir.glob("*.dxl"))
+    # glob より軽い os.scandir で列挙し、名前だけでソートしてから Path にする
+    with os.scandir(dxl_dir) as it:
+        names = sorted(e.name for e in it if e.name.lower().endswith(".dxl") and e.is_file())
+    dxl_files = [dxl_dir / name for name in names]
     if not dxl_files:
         raise RuntimeError(f"No DXL files found in: {dxl_dir}")
     return dxl_files
 
 
 
-def main() -> None:
+def _upload_one(client: GraphClient, section_id: str, payload: PagePayload, ledger: UploadLedger) -> bool:
+    """
+    OneNoteページを1件作成する（大きい画像/添付の一時ファイルは送信後に消す）。
+    - 台帳に完了として載っているDXLは送らずに False を返す
+    - 未完了（前回 PATCH の途中で失敗した）ページは削除してから作り直す
+    - ページIDは POST 直後に未完了として記録し、PATCH まで終わったら完了にする
+    """
+    try:
+        entry = ledger.get(section_id, payload.source_key)
+        if entry is not None:
+            page_id, complete = entry
+            if complete:
+                logger.info("Skip already uploaded page: %s", payload.page_title)
+                return False
+            logger.warning("Recreate incomplete page: %s page_id=%s", payload.page_title, page_id)
+            _delete_page(client, page_id)
+
+        def on_created(page: dict) -> None:
+            ledger.record(section_id, payload.source_key, page["id"], source=payload.page_title, complete=False)
+
+        page = client.create_onenote_page(
+            section_id=section_id,
+            page_payload=payload,
+            on_created=on_created,
+        )
+        ledger.record(section_id, payload.source_key, page["id"], source=payload.page_title)
+        return True
+    finally:
+        release_segment_files(payload.segment_list)
 
-    setup_logging(level="DEBUG")
-    
-    settings = _load_settings()
-    dxl_files = _load_dxl_files(settings.dxl_dir)
-    client = GraphClient(settings.access_token)
 
+def _delete_page(client: GraphClient, page_id: str) -> None:
+    """ページを削除する（既に無ければ何もしない）。"""
+    try:
+        client.delete(f"/me/onenote/pages/{quote(page_id)}")
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+
+
+def _upload_pages(
+    client: GraphClient,
+    section_id: str,
+    dxl_files: list[Path],
+    settings: AppSettings,
+    ledger: UploadLedger,
+) -> int:
+    """
+    DXLを変換しながら（プロセスプールで先読み）、OneNoteページを作成する。
+    - upload_workers=1 : 入力順に1件ずつ作成（sleep_sec 間隔）
+    - upload_workers>1 : スレッドで並列に作成（送信ペースは GraphClient 側の制限に任せる。作成順は不定）
+    - 台帳（ledger）で作成済みのDXLは送らない（戻り値の件数にも含めない）
+    """
     created = 0
 
-    try:
-        # 対象OneNoteのノートブックID・セクションIDの取得
-        notebook_id = find_notebook_id(client, settings.notebook_name)
-        section_id = find_section_id(client, notebook_id, settings.section_name)
+    # タイトル・本文・画像/添付ファイルの作成（入力順で返ってくる）
+    payloads = build_page_payloads(dxl_files)
 
+    try:
+        if settings.upload_workers <= 1:
+            try:
+                for payload in payloads:
+                    if not _upload_one(client, section_id, payload, ledger):
+                        continue
+                    created += 1
+
+                    if settings.sleep_sec:
+                        time.sleep(settings.sleep_sec)
+            except Exception:
+                logger.error("Upload stopped by an error. Created pages before the error: %s", created)
+                raise
+
+            return created
+
+        # 送信待ちのPayload（バイナリ込み）を溜め込まないよう、未完了は workers*2 件までにする
+        limit = settings.upload_workers * 2
+        with ThreadPoolExecutor(max_workers=settings.upload_workers) as ex:
+            pending: dict[Future[bool], PagePayload] = {}
+            try:
+                for payload in payloads:
+                    if len(pending) >= limit:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            del pending[f]
+                            created += f.result()
+                    pending[ex.submit(_upload_one, client, section_id, payload, ledger)] = payload
+
+                for f in as_completed(list(pending)):
+                    del pending[f]
+                    created += f.result()
+            except BaseException:
+                # 1件でも失敗したら、まだ始まっていない分は送らない（一時ファイルはここで消す）
+                for f, payload in pending.items():
+                    if f.cancel():
+                        release_segment_files(payload.segment_list)
+                # 送信中だった分は完了を待って件数に含める（失敗した分のエラーはログに残す）
+                for f in as_completed([f for f in pending if not f.cancelled()]):
+                    if f.exception() is None:
+                        created += f.result()
+                    else:
+                        logger.error("Upload failed: %s", f.exception())
+                logger.error("Upload stopped by an error. Created pages before the error: %s", created)
+                raise
+
+        return created
+    finally:
+        # 途中で失敗しても、先読み済みで未送信の Payload の一時ファイルを残さない
+        payloads.close()
 
-        # 削除したいとき
-        delete_all_pages_in_section(client, section_id)
 
-        # # DXLファイルを1件ずつ処理
-        # for i, dxl_path in enumerate(dxl_files, start=1):
 
-        #     # タイトル・本文・画像/添付ファイルの作成
-        #     payload = build_page_payload(
-        #         dxl_path,
-        #         row_no=i,
-        #     )
+def _run(client: GraphClient, section_id: str, dxl_files: list[Path], settings: AppSettings) -> None:
+    """対象セクションに対する処理本体。"""
+    ledger = UploadLedger(settings.ledger_path)
 
+    # 削除したいとき（ページが無くなるので台帳の記録も消す）
+    delete_all_pages_in_section(client, section_id)
+    ledger.forget_section(section_id)
 
-        #     # OneNoteページ作成のリクエスト
-        #     client.create_onenote_page(
-        #         section_id=section_id,
-        #         page_payload=payload
-        #     )
+    # # DXLファイルを変換してページ作成
+    # created = _upload_pages(client, section_id, dxl_files, settings, ledger)
+    # print(f"Done. Created pages: {created}")
 
-        #     created += 1
 
+def main() -> None:
 
-        #     if settings.sleep_sec:
-        #         time.sleep(settings.sleep_sec)
+    setup_logging(level="DEBUG")
+    
+    settings = _load_settings()
+    dxl_files = _load_dxl_files(settings.dxl_dir)
+    client = GraphClient(
+        settings.access_token,
+        max_concurrency=settings.upload_workers if settings.upload_workers > 1 else None,
+        patch_workers=settings.patch_workers,
+    )
 
-        # print(f"Done. Created pages: {created}")
+    try:
+        # 対象OneNoteのノートブックID・セクションIDの取得（前回の結果が有効ならファイルから）
+        notebook_id, section_id = find_notebook_and_section_ids_cached(
+            client,
+            settings.notebook_name,
+            settings.section_name,
+            cache_path=settings.id_cache_path,
+            ttl_sec=settings.id_cache_ttl_sec,
+        )
+
+        try:
+            _run(client, section_id, dxl_files, settings)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # キャッシュのIDが古い（セクションが作り直された等）可能性があるので、1回だけ引き直す
+            forget_cached_ids(settings.id_cache_path, settings.notebook_name, settings.section_name)
+            fresh_ids = find_notebook_and_section_ids_cached(
+                client,
+                settings.notebook_name,
+                settings.section_name,
+                cache_path=settings.id_cache_path,
+                ttl_sec=settings.id_cache_ttl_sec,
+            )
+            if fresh_ids == (notebook_id, section_id):
+                raise
+            notebook_id, section_id = fresh_ids
+            _run(client, section_id, dxl_files, settings)
 
     finally:
         client.close()
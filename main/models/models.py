@@ -1,9 +1,12 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import Optional, Dict, List
-from main.dxl_attachments import DxlAttachment
-from typing import Literal
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Literal, Optional
+
+if TYPE_CHECKING:
+    # 型注釈のみで使う（モデル定義の import だけで lxml まで読み込まない）
+    from main.dxl_attachments import DxlAttachment
 
 
 # =========================
@@ -17,10 +20,12 @@ class PagePayload:
     - page_title        ページタイトル
     - body_html         ページ本文（プレースホルダ込み）
     - segment_list      セグメントデータ全件（バイナリデータを内包）
+    - source_key        元DXLの内容から作った冪等キー（再実行時の重複作成防止用）
     """
     page_title: str
     body_html: str
     segment_list: List[Segment] = field(default_factory=list)
+    source_key: str | None = None
 
 
 # =========================
@@ -49,7 +54,9 @@ class MultipartPageRequest:
 
 
 
-@dataclass
+# DXL 1件ごとに生成される（OneNoteRowBuilder.build で1回だけ、以後は変更しない）。
+# 件数が多いので slots でメモリと属性アクセスを軽くする
+@dataclass(frozen=True, slots=True)
 class OneNoteRow:
     # ---- 固定フィールド
     SAVEFLAG: Optional[str] = None
@@ -140,7 +147,8 @@ class OneNoteRow:
 
 
 
-@dataclass(slots=True)
+# 画像/添付ごとに作られる（作成後は変更しない）。件数が多いので slots で軽くする
+@dataclass(frozen=True, slots=True)
 class Segment:
     segment_id: str          # data-id に使用
     kind: Literal["image", "attachment"]
@@ -149,12 +157,13 @@ class Segment:
 
 
 # OneNoteページ作成時のバイナリパートデータモデル
-@dataclass(frozen=True)
+# data は bytes のほか、一時ファイル等の Path も可（送信時にストリームで読む）
+@dataclass(frozen=True, slots=True)
 class BinaryPart:
     kind: Literal["image", "attachment"]
     filename: str
     content_type: str
-    data: bytes
+    data: bytes | Path
     origin_field: str
     width: int | None = None
     height: int | None = None
@@ -174,7 +183,7 @@ class OneNoteCreatePagePayload:
 
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PendingPart:
     """変換段階の素材（name未確定）。送信段階で BinaryPart に変換する。"""
     placeholder_id: str             # data-id (ターゲット指定に使う)
@@ -1,19 +1,23 @@
 # dxl_to_page_material.py
 from __future__ import annotations
 
-import base64
 import html
+import os
 import re
-import xml.etree.ElementTree as ET
-from typing import Optional
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+
+from lxml import etree
 
 from main.models.models import OneNoteRow
-from main.dxl_to_model import dxl_to_onenote_row
-from main.dxl_attachments import extract_attachments_from_dxl
+from main.dxl_to_model import OneNoteRowBuilder, iter_dxl_items
+from main.dxl_attachments import DxlAttachment, attachment_from_file_item, decode_base64_text
 from main.models.models import Segment, BinaryPart
 from main.config import RICH_FIELDS
+from main.logging.logging_config import init_worker_logging, worker_logging_initargs
 from typing import Any
-from pprint import pprint
 import logging
 logger = logging.getLogger(__name__)
 
@@ -22,6 +26,9 @@ logger = logging.getLogger(__name__)
 
 DXL_NS = {"dxl": "http://www.lotus.com/dxl"}
 
+# lxml のタグは "{名前空間}ローカル名" なので、比較用の定数はこの接頭辞付きで作る
+_NS_PREFIX = f"{{{DXL_NS['dxl']}}}"
+
 # DXL内の画像タグ名 -> MIMEタイプ
 _BINARY_TAG_TO_MIME = {
     "gif": "image/gif",
@@ -30,16 +37,61 @@ _BINARY_TAG_TO_MIME = {
     "jpg": "image/jpeg",
 }
 
+# 名前空間付きタグ -> (拡張子, MIMEタイプ)（子要素ごとのタグ分解を避けるため事前に作っておく）
+_BINARY_TAG_FQ = {
+    _NS_PREFIX + tag: (tag, mime) for tag, mime in _BINARY_TAG_TO_MIME.items()
+}
 
-def make_anchor(seg_id: str) -> str:
-    sid = html.escape(seg_id, quote=True)
-    return f"<div id='{sid}' data-id='{sid}'></div>"
-
+# 名前空間付きタグ（子要素のタグ判定用）
+_TAG_PAR = _NS_PREFIX + "par"
+_TAG_TABLE = _NS_PREFIX + "table"
+_TAG_ATTACHMENTREF = _NS_PREFIX + "attachmentref"
+_TAG_PICTURE = _NS_PREFIX + "picture"
+_TAG_TABLEROW = _NS_PREFIX + "tablerow"
+_TAG_TABLECELL = _NS_PREFIX + "tablecell"
+
+# 繰り返し使う XPath / 正規表現（モジュール読込時に1回だけコンパイル）
+_RICHTEXT = etree.XPath("dxl:richtext", namespaces=DXL_NS)
+_PX_RE = re.compile(r"(\d+)")
+_WS_NL_RE = re.compile(r"\s+\n")
+
+# par のテキスト抽出で読み飛ばす要素（画像・添付などバイナリ系）
+_BINARY_LOCAL_TAGS = frozenset({
+    "picture",
+    "notesbitmap",
+    "gif",
+    "png",
+    "jpeg",
+    "jpg",
+    "filedata",
+    "attachmentref",
+})
+_BINARY_TAGS_FQ = frozenset(_NS_PREFIX + t for t in _BINARY_LOCAL_TAGS)
+
+# richtext 内にバイナリ系要素が1つも無いか（テキストだけのフィールドの判定用）
+_HAS_NO_BINARY = etree.XPath(
+    "not(" + " | ".join(f".//dxl:{t}" for t in sorted(_BINARY_LOCAL_TAGS)) + ")",
+    namespaces=DXL_NS,
+)
+
+# バイナリ系要素の外にあるテキストだけを文書順に取る（画像入りの表のセル用）
+_TEXT_WITHOUT_BINARY = etree.XPath(
+    "descendant::text()[not(" + " or ".join(f"ancestor::dxl:{t}" for t in sorted(_BINARY_LOCAL_TAGS)) + ")]",
+    namespaces=DXL_NS,
+    smart_strings=False,
+)
+
+# これより大きいバイナリは一時ファイルに書き出し、BinaryPart には Path を持たせる
+# （先読み中のPayloadやプロセス間の受け渡しでデコード済みバイナリを抱え込まないため。送信時はファイルから読む）
+_SPILL_THRESHOLD = 1 << 20
+
+# RichText として扱うフィールド名（item ごとの判定用）
+_RICH_FIELD_SET = frozenset(RICH_FIELDS)
 
 
-def _local_tag(tag: str) -> str:
-    """タグのローカル名だけ返す（XMLの名前空間を削除）"""
-    return tag.split("}", 1)[1] if "}" in tag else tag
+def make_anchor(seg_id: str) -> str:
+    sid = html.escape(seg_id)
+    return f"<div id='{sid}' data-id='{sid}'></div>"
 
 
 
@@ -47,38 +99,70 @@ def _safe_px(v: Optional[str]) -> Optional[int]:
     """px表記や数値文字列から幅/高さを安全に抽出する。"""
     if not v:
         return None
-    m = re.search(r"(\d+)", v)
+    # よくある "320" のような数字だけの値は正規表現を使わない
+    # （int() に直接渡すと "-5" や "1_000" も通ってしまうので ASCII 数字のみに限定）
+    if v.isascii() and v.isdigit():
+        return int(v)
+    m = _PX_RE.search(v)
     return int(m.group(1)) if m else None
 
 
 
-def _par_text_without_binary(par: ET.Element) -> str:
+def _par_text_without_binary(par: etree._Element) -> str:
     """
     par 内のテキストのみ抽出（バイナリの文字列削除）
+    - 再帰・文字列の継ぎ足しはせず、スタックで文書順に辿って最後に1回だけ join する
+    - スタックには要素と、子要素の後に出力する tail（文字列）を積む
+    """
+    parts: list[str] = []
+    stack: list[etree._Element | str] = [par]
+
+    while stack:
+        el = stack.pop()
+        if isinstance(el, str):
+            parts.append(el)
+            continue
+
+        if el.tag in _BINARY_TAGS_FQ:
+            # バイナリ系要素は中身を読まず、後ろのテキスト（tail）だけ残す
+            if el.tail:
+                parts.append(el.tail)
+            continue
+
+        if el.text:
+            parts.append(el.text)
+        if el.tail:
+            stack.append(el.tail)
+        stack.extend(reversed(el))
+
+    return _WS_NL_RE.sub("\n", "".join(parts)).strip()
+
+
+def _par_text_plain(par: etree._Element) -> str:
+    """
+    バイナリ系要素を含まない par のテキスト（_par_text_without_binary と同じ結果）
+    - 読み飛ばす要素が無いので、lxml の C 実装でまとめて取り出す（末尾の tail も含める）
     """
-    skip = {
-        "picture",
-        "notesbitmap",
-        "gif",
-        "png",
-        "jpeg",
-        "jpg",
-        "filedata",
-        "attachmentref",
-    }
+    txt = etree.tostring(par, method="text", encoding="unicode", with_tail=True)
+    return _WS_NL_RE.sub("\n", txt).strip()
 
-    def walk(el: ET.Element) -> str:
-        tag = _local_tag(el.tag)
-        if tag in skip:
-            return el.tail or ""
 
-        s = el.text or ""
-        for ch in list(el):
-            s += walk(ch)
-        s += el.tail or ""
-        return s
 
-    return re.sub(r"\s+\n", "\n", walk(par)).strip()
+def _spill_if_large(data: bytes, suffix: str) -> bytes | Path:
+    """大きいバイナリは一時ファイルへ書き出して Path を返す（後始末は release_segment_files）"""
+    if len(data) <= _SPILL_THRESHOLD:
+        return data
+    with tempfile.NamedTemporaryFile(prefix="dxl_part_", suffix=suffix, delete=False) as f:
+        f.write(data)
+    return Path(f.name)
+
+
+def release_segment_files(segments: Iterable[Segment]) -> None:
+    """_spill_if_large で書き出した一時ファイルを削除する（送信が終わったら呼ぶ）"""
+    for seg in segments:
+        data = seg.binary_part.data
+        if isinstance(data, Path):
+            data.unlink(missing_ok=True)
 
 
 
@@ -90,7 +174,8 @@ def _attref_to_segment(
     segment_id: str,
     attachment_by_name: dict[str, Any],
 ) -> Segment | None:
-    a = attachment_by_name.get(filename)
+    # attachment_by_name のキーは casefold 済み（attachmentref と $FILE で大文字小文字が違うことがある）
+    a = attachment_by_name.get(filename.casefold())
     if not a:
         # 実体が無いなら埋め込みできない（アンカーは残る）
         return None
@@ -99,16 +184,31 @@ def _attref_to_segment(
         kind="attachment",
         filename=a.filename,
         content_type=(a.mime or "application/octet-stream"),
-        data=a.content,
+        data=_spill_if_large(a.content, Path(a.filename).suffix),
         origin_field="$FILE",
     )
     return Segment(segment_id=segment_id, kind="attachment", binary_part=binary)
 
 
 
+def _resolve_attref(
+    ref: tuple[str, str, str],
+    attachment_by_name: dict[str, Any],
+) -> Segment | None:
+    """richtext_item_to_html_and_segment で保留した添付 (ファイル名, フィールド名, セグメントID) を解決する。"""
+    filename, field_name, segment_id = ref
+    return _attref_to_segment(
+        filename=filename,
+        field_name=field_name,
+        segment_id=segment_id,
+        attachment_by_name=attachment_by_name,
+    )
+
+
+
 # picture要素からセグメントデータを作成する
 def _picture_to_segment(
-    pic: ET.Element,
+    pic: etree._Element,
     *,
     field_name: str,
     seg_id: str,
@@ -117,18 +217,19 @@ def _picture_to_segment(
     h = _safe_px(pic.get("height"))
 
     # 画像バイナリの取り出し
-    for child in list(pic):
-        tag = _local_tag(child.tag)
-        mime = _BINARY_TAG_TO_MIME.get(tag)
-        if not mime:
+    for child in pic:
+        hit = _BINARY_TAG_FQ.get(child.tag)
+        if hit is None:
             continue
+        tag, mime = hit
 
-        b64 = (child.text or "").strip()
-        if not b64:
+        # 改行/空白はデコーダが読み飛ばすので strip() でコピーを作らない
+        b64 = child.text
+        if not b64 or b64.isspace():
             continue
 
         try:
-            data = base64.b64decode(b64)
+            data = decode_base64_text(b64)
         except Exception:
             return None
 
@@ -138,7 +239,7 @@ def _picture_to_segment(
             kind="image",
             filename=filename,
             content_type=mime,
-            data=data,
+            data=_spill_if_large(data, f".{tag}"),
             origin_field=field_name,
             width=w,
             height=h,
@@ -149,57 +250,80 @@ def _picture_to_segment(
 
 
 
-def _table_to_html(table_el: ET.Element) -> str:
+# テーブル変換で毎回同じになるタグ
+_TABLE_OPEN = "<div style='margin:10px 0;'><table style='border-collapse:collapse; width:100%;'>"
+_TABLE_CLOSE = "</table></div>"
+_TD_OPEN = "<td style='border:1px solid #ddd; padding:6px; vertical-align:top;'>"
+
+
+def _cell_text_plain(td: etree._Element) -> str:
+    return "".join(td.itertext())
+
+
+def _cell_text_without_binary(td: etree._Element) -> str:
+    return "".join(_TEXT_WITHOUT_BINARY(td))
+
+
+def _table_to_html(table_el: etree._Element) -> str:
     """
     richtext 内の <table> をシンプルに HTML table に変換する（テキストのみ）。
-    - セル内の画像/添付(ref)は想定しない（あっても無視）
+    - セル内の画像/添付(ref)は想定しない（あっても無視。base64 の文字列もセルに出さない）
     - 余計な装飾は最低限
     """
-    rows: list[str] = []
+    # 全体を軽く囲う（見やすさ用）。断片は1つのリストに積んで最後に1回だけ join する
+    out: list[str] = [_TABLE_OPEN]
+
+    # 表の中に画像/添付が無ければ itertext で一括取得、あればバイナリ（base64）の文字列を除いて取得
+    # （判定は表ごとに1回。セルごとに判定はしない）
+    if _HAS_NO_BINARY(table_el):
+        cell_text = _cell_text_plain
+    else:
+        cell_text = _cell_text_without_binary
 
     # DXL: <table> -> <tablerow> -> <tablecell>
-    tablerows = table_el.findall("dxl:tablerow", DXL_NS)
-    for tr in tablerows:
-        cells_html: list[str] = []
-        cells = tr.findall("dxl:tablecell", DXL_NS)
+    # 子要素はリストにせず、タグで絞り込みながら順に辿る
+    for tr in table_el.iterchildren(_TAG_TABLEROW):
+        out.append("<tr>")
 
-        for td in cells:
+        for td in tr.iterchildren(_TAG_TABLECELL):
             # セル内テキスト（子孫含めて全部）を取得
-            txt = "".join(td.itertext()).strip()
-            txt = re.sub(r"\s+\n", "\n", txt)
+            txt = cell_text(td).strip()
+            txt = _WS_NL_RE.sub("\n", txt)
             safe = html.escape(txt).replace("\n", "<br/>") if txt else ""
-            cells_html.append(
-                f"<td style='border:1px solid #ddd; padding:6px; vertical-align:top;'>{safe}</td>"
-            )
-
-        rows.append("<tr>" + "".join(cells_html) + "</tr>")
-
-    # 全体を軽く囲う（見やすさ用）
-    return (
-        "<div style='margin:10px 0;'>"
-        "<table style='border-collapse:collapse; width:100%;'>"
-        + "".join(rows)
-        + "</table>"
-        "</div>"
-    )
+            out += (_TD_OPEN, safe, "</td>")
+
+        out.append("</tr>")
+
+    out.append(_TABLE_CLOSE)
+    return "".join(out)
 
 
 
 def richtext_item_to_html_and_segment(
-    item_el: ET.Element,    # DXLのitem要素
+    item_el: etree._Element,    # DXLのitem要素
     attachment_by_name: dict[str, Any],
     *,
     seg_i: int,
-) -> tuple[str, list[Segment], int]:
-    
+    unresolved: list[tuple[str, str, str]] | None = None,
+) -> tuple[str, list[Segment | None], int]:
+    """
+    RichText の item を HTML（セグメントアンカー付き）とセグメントに変換する。
+
+    attachment_by_name のキーは添付ファイル名を casefold したもの。
+    unresolved を渡した場合、attachment_by_name に未登録の添付は
+    segment_list に None を置き、(ファイル名, フィールド名, セグメントID) を unresolved に積む。
+    （$FILE が RichText より後ろに出てくる DXL を1回の走査で処理するため。呼び出し側で後から解決する）
+    """
+
     # フィールド名取得
     field_name = (item_el.get("name") or "unknown").strip()
 
     # 実際にリッチテキストが入っていなければ処理をスキップ（消していいかも）
-    rt = item_el.find("dxl:richtext", DXL_NS)
-    if rt is None:
+    rts = _RICHTEXT(item_el)
+    if not rts:
         logger.warning("richtext not found. skip field=%s", field_name)
         return "", [], seg_i
+    rt = rts[0]
 
 
 
@@ -209,15 +333,30 @@ def richtext_item_to_html_and_segment(
     # セグメントデータ（バイナリデータを内包）のリスト
     segment_list: list[Segment] = []
 
-    for child in list(rt):
-        tag = _local_tag(child.tag)
+    # テキストだけのフィールド（大半）は、par ごとの添付/画像の検索と再帰走査を省く
+    if _HAS_NO_BINARY(rt):
+        for child in rt:
+            if child.tag == _TAG_PAR:
+                out.append(f"<p>{html.escape(_par_text_plain(child))}</p>")
+            elif child.tag == _TAG_TABLE:
+                out.append(_table_to_html(child))
+        return "\n".join(out), segment_list, seg_i
+
+    for child in rt:
+        tag = child.tag
 
         # 「parタグ」の走査
-        if tag == "par":
+        if tag == _TAG_PAR:
             par = child
 
-            # 添付ファイル
-            attrefs = par.findall(".//dxl:attachmentref", DXL_NS)
+            # 添付ファイル・画像を1回の走査でまとめて拾う（文書順）
+            attrefs: list[etree._Element] = []
+            pics: list[etree._Element] = []
+            for el in par.iter(_TAG_ATTACHMENTREF, _TAG_PICTURE):
+                if el.tag == _TAG_ATTACHMENTREF:
+                    attrefs.append(el)
+                else:
+                    pics.append(el)
 
             if attrefs:
                 for a in attrefs:
@@ -241,6 +380,9 @@ def richtext_item_to_html_and_segment(
 
                     if seg:
                         segment_list.append(seg)
+                    elif unresolved is not None and fn.casefold() not in attachment_by_name:
+                        segment_list.append(None)
+                        unresolved.append((fn, field_name, seg_id))
 
                     seg_i += 1
 
@@ -248,10 +390,9 @@ def richtext_item_to_html_and_segment(
 
 
 
-            # 画像データ（キャプチャ）の走査
-            pic = par.find(".//dxl:picture", DXL_NS)
-
-            if pic is not None:
+            # 画像データ（キャプチャ）
+            if pics:
+                pic = pics[0]
 
                 # セグメントIDの作成
                 seg_id = f"seg-{seg_i:03d}"
@@ -280,7 +421,7 @@ def richtext_item_to_html_and_segment(
 
 
         # 「tableタグ」の走査
-        if tag == "table":
+        if tag == _TAG_TABLE:
             table_html = _table_to_html(child)
             out.append(table_html)
 
@@ -291,31 +432,45 @@ def richtext_item_to_html_and_segment(
 def create_materials_from_dxl(
     dxl_path: str,
 ) -> tuple[OneNoteRow, list[Segment]]:
+    """
+    DXL1件から OneNoteRow とセグメント（画像/添付）を作る。
+    大きいバイナリは一時ファイルに書き出すので、使い終わったら release_segment_files を呼ぶこと。
+    """
 
-    all_segment: list[Segment] = []
-
-
-    # 1件分の全データ取得
-    note = dxl_to_onenote_row(dxl_path)
-    root = ET.parse(dxl_path).getroot()
+    # 未解決の添付（None）を含むセグメント列（走査後に解決する）
+    all_segment: list[Segment | None] = []
+    unresolved: list[tuple[str, str, str]] = []
 
-    # 添付ファイル（$FILE）全件を抽出
-    attachment_objs_all = extract_attachments_from_dxl(dxl_path) or []
-    attachment_by_name = {a.filename: a for a in attachment_objs_all}
+    # 添付ファイル（$FILE）は同じ走査の中で集める
+    attachment_objs_all: list[DxlAttachment] = []
+    attachment_by_name: dict[str, DxlAttachment] = {}
 
 
     # セグメント連番
     seg_i = 1
 
+    builder = OneNoteRowBuilder()
+    converted: set[str] = set()
 
-    # RichTextフィールドに対して下記を行う
-    # ・HTML変換
+    # DXLを1回だけ走査し、item ごとに下記を行う
+    # ・OneNoteRow 用の値の抽出
+    # ・RichTextフィールドのHTML変換
     # ・埋め込みファイル（キャプチャ画像やExcelなど）の抽出
-    for field_name in RICH_FIELDS:
+    for item in iter_dxl_items(dxl_path):
+        field_name = item.get("name")
+        is_rich = field_name in _RICH_FIELD_SET
 
-        # 対象フィールド（型：RichText）をセット
-        item = root.find(f".//dxl:item[@name='{field_name}']", DXL_NS)
-        if item is None:
+        if field_name == "$FILE":
+            a = attachment_from_file_item(item)
+            if a is not None:
+                attachment_objs_all.append(a)
+                attachment_by_name[a.filename.casefold()] = a
+
+        # RichTextはHTMLで置き換えるので、プレーンテキストの抽出は省く
+        builder.add_item(item, extract_value=not is_rich)
+
+        # 対象フィールド（型：RichText）のみ（同名itemが複数ある場合は先頭のみ）
+        if not is_rich or field_name in converted:
             continue
 
         # フィールド（RichText）から下記を取得
@@ -325,19 +480,66 @@ def create_materials_from_dxl(
             item,
             attachment_by_name,
             seg_i=seg_i,
+            unresolved=unresolved,
         )
 
-        setattr(note, field_name, field_html or "")
+        builder.set_field(field_name, field_html or "")
+        converted.add(field_name)
 
         all_segment.extend(segment_list)
 
+    # RichText より後ろにあった添付を解決する（見つからない添付はアンカーだけ残る）
+    if unresolved:
+        pending = iter(unresolved)
+        all_segment = [
+            s if s is not None else _resolve_attref(next(pending), attachment_by_name)
+            for s in all_segment
+        ]
+    segments = [s for s in all_segment if s is not None]
+
     # note側には全添付名だけ残す（メタとして）
     if attachment_objs_all:
-        note.attachments = [a.filename for a in attachment_objs_all]
+        builder.set_field("attachments", [a.filename for a in attachment_objs_all])
 
+    # 1件分の全データ（RichTextはHTML）をここで1回だけ生成
+    note = builder.build()
 
-    for s in all_segment:
-        print(s.segment_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("segments: %s", [s.segment_id for s in segments])
 
+    return note, segments
 
-    return note, all_segment
+
+
+def create_materials_from_dxl_batch(
+    dxl_paths: Sequence[str],
+    *,
+    max_workers: int | None = None,
+) -> list[tuple[OneNoteRow, list[Segment]]]:
+    """
+    複数DXLを create_materials_from_dxl でまとめて変換する（入力順で返す）。
+    - ファイルごとに独立したCPU処理（XML解析・base64デコード）なので、プロセスプールでGILを避ける
+    - 全件の結果（バイナリ込み）をメモリに持つので、件数が多い場合は page_payload_builder.build_page_payloads を使う
+    - 返したセグメントの一時ファイル（大きいバイナリ）は呼び出し側の持ち物。使い終わったら
+      release_segment_files で消すこと（途中で失敗した場合は、変換済み分をここで消してから例外を送出する）
+    """
+    workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker_logging,
+        initargs=worker_logging_initargs(),
+    ) as ex:
+        futures = [ex.submit(create_materials_from_dxl, path) for path in dxl_paths]
+        try:
+            return [f.result() for f in futures]
+        except BaseException:
+            # 呼び出し側に渡らない結果の一時ファイルを残さない（未着手の分は取り消す）
+            for f in futures:
+                if f.cancel():
+                    continue
+                try:
+                    _, segments = f.result()
+                except Exception:
+                    continue
+                release_segment_files(segments)
+            raise
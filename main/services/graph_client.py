@@ -1,25 +1,59 @@
 from __future__ import annotations
 
 import html
+import json
+import random
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+from itertools import islice
+from typing import Any, Callable, Dict, List, Mapping, Optional
 from urllib.parse import quote
 
-import requests
 import logging
 
+import requests
+from requests.adapters import HTTPAdapter
+
 from main.models.models import PagePayload, Segment
 from main.logging.graph_logging import mask_headers, summarize_request_kwargs, truncate_text
 from main.services.segments_body import _segment_to_html, _inject_segments_into_body, _inject_first_segments
-import json
-from typing import List
+from main.services.multipart_body import MultipartBody, MultipartPart
+from main.services.graph_throttle import AimdLimiter, RequestRateWindow
 
+try:
+    # あれば orjson で bytes のまま解析/生成する（標準 json より速く、str を経由しない）
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
-from pprint import pprint
+# Graph API のベースURL（相対パスで渡されたURLはここに連結する）
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+
+# 通信エラー時に再送してよいメソッド（同じリクエストを2回送っても結果が変わらない）
+_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+# ページ作成（Presentation）のXHTMLの固定部分（エンコード済み）。タイトルと本文だけをページごとに埋める
+_XHTML_HEAD = b"<!DOCTYPE html>\n        <html>\n        <head>\n        <title>"
+_XHTML_MID = b"</title>\n        </head>\n        <body>\n        "
+_XHTML_TAIL = b"\n        </body>\n        </html>"
+
+
+def _response_json(resp: requests.Response) -> Any:
+    """
+    レスポンスボディをJSONとして解析する。
+    - resp.json() のように一度 str にデコードせず、bytes のまま解析する
+    - 解析できない場合（想定外のボディ）は resp.json() に任せてエラー内容を揃える
+    """
+    try:
+        return _json_loads(resp.content)
+    except ValueError:
+        return resp.json()
 
-MultipartPart = Tuple[str, bytes, str]  # (filename, content, content_type)
 
 @dataclass(frozen=True)
 class GraphRetryPolicy:
@@ -28,6 +62,26 @@ class GraphRetryPolicy:
     max_retries: int = 5
     retry_statuses: tuple[int, ...] = (429, 503)
     default_retry_after: int = 2
+    max_backoff: float = 60.0  # 待機秒数の上限（Retry-After がこれより長ければそちらを優先）
+    rpm_limit: Optional[int] = None  # 1分あたりの送信数の上限（指定時は超えないよう送信前に待つ）
+    # (接続, 読み取り) のタイムアウト秒数。止まった接続でスレッドや同時実行枠を握り続けないようにする
+    # （大きい画像/添付の送信・ページ作成の応答待ちがあるので、読み取りは長めにしておく）
+    timeout: tuple[float, float] = (10.0, 120.0)
+
+    def next_wait(self, retry_after: Optional[str | float], prev_wait: float) -> float:
+        """
+        再試行までの待機秒数を決める（decorrelated jitter）。
+        - Retry-After を下限として守る
+        - 前回の待機（初回は下限）の3倍までの範囲でランダムにばらし、同時に throttling されたリクエストが一斉に再送しないようにする
+          （初回から幅を持たせる。prev_wait=0 でも下限ちょうどに揃わない）
+        - 上限は max_backoff（Retry-After がこれより長ければ Retry-After を待つ）
+        """
+        try:
+            base = float(retry_after) if retry_after is not None else float(self.default_retry_after)
+        except ValueError:
+            base = float(self.default_retry_after)
+        upper = min(self.max_backoff, max(base, prev_wait) * 3)
+        return max(base, random.uniform(base, upper))
 
 
 class GraphClient:
@@ -35,8 +89,12 @@ class GraphClient:
     Microsoft Graph APIの呼び出しをシンプルに扱うためのクライアント
 
     - 401は即座に例外
-    - 429/503はRetry-Afterで待って再試行
+    - 429/503はRetry-After（+ジッター）で待って再試行
     - 成功時はResponseを返す
+    - max_concurrency を指定すると、同時に送信するリクエスト数を制限する（スレッド間で共有）
+      上限は AIMD で調整する（429/503/5xx で半分、成功で少しずつ max_concurrency まで戻す）
+    - retry_policy.rpm_limit を指定すると、直近1分の送信数がそれを超えないよう送信前に待つ
+    - patch_workers を2以上にすると、1ページの6個目以降の画像/添付の PATCH を並列に送る
     """
 
     def __init__(
@@ -45,11 +103,23 @@ class GraphClient:
         *,
         session: Optional[requests.Session] = None,
         retry_policy: Optional[GraphRetryPolicy] = None,
+        max_concurrency: Optional[int] = None,
+        patch_workers: int = 1,
     ) -> None:
         self._access_token = access_token
+        self._patch_workers = max(1, patch_workers)
         self._session = session or requests.Session()
         self._owns_session = session is None
+
+        if self._owns_session:
+            # 接続プールを同時実行数に合わせて確保し、ページごとのTLS接続をやり直さない（keep-aliveで再利用）
+            pool_size = max(10, (max_concurrency or 0) * self._patch_workers)
+            self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+            # Authorization は Session に1回だけ設定する（リクエストごとのヘッダー結合を省く）
+            self._session.headers["Authorization"] = f"Bearer {access_token}"
         self._retry = retry_policy or GraphRetryPolicy()
+        self._limiter = AimdLimiter(max_concurrency) if max_concurrency else None
+        self._rate_window = RequestRateWindow(self._retry.rpm_limit) if self._retry.rpm_limit else None
         self._logger = logging.getLogger(__name__)
 
 
@@ -58,13 +128,30 @@ class GraphClient:
         if self._owns_session:
             self._session.close()
     
+    @staticmethod
+    def _resolve_url(url: str) -> str:
+        # "/me/onenote/..." のような相対パスはベースURLに連結する（nextLink等の絶対URLはそのまま）
+        if url.startswith("/"):
+            return GRAPH_BASE_URL + url
+        return url
+
     def _merged_headers(self, headers: Optional[dict]) -> dict:
+        # 自前の Session なら Authorization は設定済みなので、追加ヘッダーが無ければ何もしない
+        if self._owns_session and not headers:
+            return {}
         # 呼び出し側が Authorization を渡しても上書きされるように固定
         merged = dict(headers or {})
         merged["Authorization"] = f"Bearer {self._access_token}"
         return merged
 
 
+    @staticmethod
+    def _is_retryable_exception(method: str, exc: Exception) -> bool:
+        # ConnectTimeout は接続前のタイムアウトなので、どのメソッドでも再送して安全
+        if isinstance(exc, requests.exceptions.ConnectTimeout):
+            return True
+        return method.upper() in _IDEMPOTENT_METHODS
+
     # ==============================
     # リクエスト送信・リトライ制御（共通）
     # ==============================
@@ -76,6 +163,7 @@ class GraphClient:
     #
     # ■ エラーハンドリング
     # - 429/503: Retry-After を見て待機→再試行する。
+    # - 接続エラー/タイムアウト: 接続前の失敗か冪等なメソッド（GET/DELETE 等）なら待機→再試行する。
     # - 401: アクセストークン失効/不正として例外にする。
     # - その他: raise_for_status() に委ねる（4xx/5xx は例外）。
     def _request_with_retry(
@@ -87,42 +175,86 @@ class GraphClient:
         **request_kwargs: Any,
     ) -> requests.Response:
 
+        url = self._resolve_url(url)
+
+        # タイムアウト未指定なら既定値を使う（接続タイムアウトは再試行、読み取りタイムアウトは冪等なメソッドのみ再試行）
+        request_kwargs.setdefault("timeout", self._retry.timeout)
+
         # ヘッダー構築（アクセストークンなど）
         merged_headers = self._merged_headers(headers)
 
-        # 送信前ログ（DEBUG推奨）
-        try:
-            safe_headers = mask_headers(merged_headers)
-            kw_summary = summarize_request_kwargs(dict(request_kwargs))
-            self._logger.debug(
-                "Graph request: %s %s headers=%s kwargs=%s",
-                method,
-                url,
-                safe_headers,
-                kw_summary,
-            )
-        except Exception as e:
-            self._logger.debug("Graph request log failed: %s", e)
+        # 送信前ログ（DEBUG推奨）。DEBUGが無効ならマスク/要約の処理自体を行わない
+        if self._logger.isEnabledFor(logging.DEBUG):
+            try:
+                safe_headers = mask_headers(merged_headers)
+                kw_summary = summarize_request_kwargs(request_kwargs)
+                self._logger.debug(
+                    "Graph request: %s %s headers=%s kwargs=%s",
+                    method,
+                    url,
+                    safe_headers,
+                    kw_summary,
+                )
+            except Exception as e:
+                self._logger.debug("Graph request log failed: %s", e)
 
         last_exc: Optional[Exception] = None
 
+        body = request_kwargs.get("data")
+        wait = 0.0
+
         for attempt in range(1, self._retry.max_retries + 1):
+            # ストリームのボディは再送時に先頭へ戻す
+            if hasattr(body, "seek"):
+                body.seek(0)
+
+            # client-request-id は再送も含めて送信ごとに新しい GUID にする（Graph 側のログとの突き合わせ用）
+            request_id = str(uuid.uuid4())
+            merged_headers["client-request-id"] = request_id
+
+            if self._rate_window is not None:
+                self._rate_window.wait_turn()
+
             start = time.perf_counter()
 
-            resp = self._session.request(
-                method,
-                url,
-                headers=merged_headers,
-                **request_kwargs,
-            )
+            try:
+                if self._limiter is None:
+                    resp = self._session.request(method, url, headers=merged_headers, **request_kwargs)
+                else:
+                    self._limiter.acquire()
+                    throttled = True  # 送信自体が例外になった場合も絞る側に倒す
+                    try:
+                        resp = self._session.request(method, url, headers=merged_headers, **request_kwargs)
+                        throttled = resp.status_code in self._retry.retry_statuses or resp.status_code >= 500
+                    finally:
+                        self._limiter.release(throttled=throttled)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 接続できなかった（送っていない）場合と、冪等なメソッドの通信エラーだけ再試行する。
+                # POST/PATCH は届いている可能性があるので、再送するとページや追記が重複しうる
+                if not self._is_retryable_exception(method, e) or attempt == self._retry.max_retries:
+                    raise
+                last_exc = e
+                wait = self._retry.next_wait(None, wait)
+                self._logger.warning(
+                    "Graph transient error: %s %s attempt=%s/%s wait=%.1fs request-id=%s error=%s",
+                    method,
+                    url,
+                    attempt,
+                    self._retry.max_retries,
+                    wait,
+                    request_id,
+                    e,
+                )
+                time.sleep(wait)
+                continue
 
             elapsed_ms = int((time.perf_counter() - start) * 1000)
 
             # リトライ対象（429/503）
             if resp.status_code in self._retry.retry_statuses:
-                wait = int(resp.headers.get("Retry-After", self._retry.default_retry_after))
+                wait = self._retry.next_wait(resp.headers.get("Retry-After"), wait)
                 self._logger.warning(
-                    "Graph retryable response: %s %s status=%s attempt=%s/%s wait=%ss elapsed=%sms",
+                    "Graph retryable response: %s %s status=%s attempt=%s/%s wait=%.1fs elapsed=%sms request-id=%s",
                     method,
                     url,
                     resp.status_code,
@@ -130,6 +262,7 @@ class GraphClient:
                     self._retry.max_retries,
                     wait,
                     elapsed_ms,
+                    request_id,
                 )
                 time.sleep(wait)
                 continue
@@ -151,22 +284,24 @@ class GraphClient:
             except Exception as e:
                 last_exc = e
                 self._logger.error(
-                    "Graph request failed: %s %s status=%s elapsed=%sms body=%s",
+                    "Graph request failed: %s %s status=%s elapsed=%sms request-id=%s body=%s",
                     method,
                     url,
                     resp.status_code,
                     elapsed_ms,
+                    request_id,
                     truncate_text(resp.text, limit=1000),
                 )
                 raise
 
             # 成功ログ（INFO）
             self._logger.info(
-                "Graph request success: %s %s status=%s elapsed=%sms",
+                "Graph request success: %s %s status=%s elapsed=%sms request-id=%s",
                 method,
                 url,
                 resp.status_code,
                 elapsed_ms,
+                request_id,
             )
             return resp
 
@@ -190,9 +325,11 @@ class GraphClient:
     # - dict のキーが “パート名” になる（例: "Presentation", "image1", "file1"）。
     # - "Presentation" は必須で、ページ本文の XHTML/HTML を入れる。
     # - 画像/添付は本文HTML内で `name:パート名` を参照して貼り付ける。
+    # - パートの中身は bytes のほか Path / ファイルオブジェクトも可（送信時に少しずつ読む）。
     #
     # ■ 実装メモ
-    # - requests の `files=` に data_parts を渡すと multipart/form-data になる。
+    # - requests の `files=` はボディ全体をメモリ上で組み立てるため使わない。
+    #   MultipartBody（ストリーム）を `data=` に渡し、Content-Type に boundary を付ける。
     # - 送信とリトライは共通関数 `_request_with_retry()` に委譲する。
     def _request_multipart(
         self,
@@ -202,12 +339,18 @@ class GraphClient:
         data_parts: Dict[str, MultipartPart],
         headers: Optional[dict] = None,
     ) -> requests.Response:
-        return self._request_with_retry(
-            method,
-            url,
-            headers=headers,
-            files=data_parts,
-        )
+        body = MultipartBody(data_parts)
+        merged = dict(headers or {})
+        merged["Content-Type"] = body.content_type
+        try:
+            return self._request_with_retry(
+                method,
+                url,
+                headers=merged,
+                data=body,
+            )
+        finally:
+            body.close()
 
 
     # ==============================
@@ -247,9 +390,18 @@ class GraphClient:
 
 
 
+    @property
+    def retry_policy(self) -> GraphRetryPolicy:
+        """リトライ設定（$batch のサブレスポンス判定などで使う）"""
+        return self._retry
+
     def get_json(self, url: str) -> dict:
         """GETしてJSONを返す。"""
-        return self._request_json("GET", url).json()
+        return _response_json(self._request_json("GET", url))
+
+    def post_json(self, url: str, body: Any) -> dict:
+        """JSONをPOSTしてJSONを返す。"""
+        return _response_json(self._request_json("POST", url, json_body=body))
 
     def delete(self, url: str) -> None:
         """DELETEして結果を確認する。"""
@@ -274,7 +426,7 @@ class GraphClient:
         - p1..pN  : binary parts
         """
 
-        url = f"https://graph.microsoft.com/v1.0/me/onenote/pages/{page_id}/content"
+        url = f"/me/onenote/pages/{page_id}/content"
 
         commands = []
         data_parts = {}
@@ -287,27 +439,7 @@ class GraphClient:
             bp = seg.binary_part
 
             # 1) HTML断片（この seg 用に name:part_name を参照するHTMLを作る）
-            if bp.kind == "image":
-                style = "max-width:100%;"
-                if bp.width:
-                    style += f" width:{bp.width}px;"
-                if bp.height:
-                    style += f" height:{bp.height}px;"
-                content_html = (
-                    "<div style='margin:8px 0;'>"
-                    f"<img src='name:{html.escape(part_name, quote=True)}' style='{style}'/>"
-                    "</div>"
-                )
-            else:
-                fn = html.escape(bp.filename, quote=True)
-                mt = html.escape(bp.content_type or "application/octet-stream", quote=True)
-                pn = html.escape(part_name, quote=True)
-                content_html = (
-                    "<div style='margin:8px 0; padding:10px; border:1px solid #e3e3e3; "
-                    "border-radius:10px; background:#fff;'>"
-                    f"<object data='name:{pn}' data-attachment='{fn}' type='{mt}'></object>"
-                    "</div>"
-                )
+            content_html = _segment_to_html(seg, part_name=part_name)
 
             # 2) patch command：アンカー（data-id）に append
             # data-id を付けた要素は #<data-id> で target 指定できる :contentReference[oaicite:6]{index=6}
@@ -323,12 +455,10 @@ class GraphClient:
             data_parts[part_name] = (bp.filename, bp.data, bp.content_type)
 
         # Commands パートを multipart に入れる
-        commands_json = json.dumps(commands, ensure_ascii=False).encode("utf-8")
-        data_parts["Commands"] = ("commands.json", commands_json, "application/json")
+        data_parts["Commands"] = ("commands.json", _json_dumps(commands), "application/json")
 
-        # PATCH multipart
-        res = self._request_multipart("PATCH", url, data_parts=data_parts)
-        res.raise_for_status()
+        # PATCH multipart（4xx/5xx は _request_with_retry 内で例外になる）
+        self._request_multipart("PATCH", url, data_parts=data_parts)
 
 
 
@@ -338,44 +468,68 @@ class GraphClient:
         *,
         section_id: str,
         page_payload: PagePayload,
+        on_created: Optional[Callable[[dict], None]] = None,
     ) -> dict:
-        url = f"https://graph.microsoft.com/v1.0/me/onenote/sections/{section_id}/pages"
+        """
+        ページを作成する（POST で本文と先頭5個のバイナリ、残りは PATCH で追加）。
+        - on_created: POST が成功した直後（PATCH の前）に作成されたページを渡して呼ぶ。
+          PATCH が失敗してもページ自体は存在するので、呼び出し側はここで作成を記録できる
+        """
+        url = f"/me/onenote/sections/{section_id}/pages"
 
         # Graph制約: Presentation + バイナリ最大5
         MAX_BIN_PER_REQUEST = 5
         
-        all_segments = list(page_payload.segment_list or [])
-        firstSeg = all_segments[:MAX_BIN_PER_REQUEST]
-        restSeg = all_segments[MAX_BIN_PER_REQUEST:]
+        # 全件をコピーせず、先頭から5件ずつ取り出す（segment_list がイテレータでも可）
+        seg_iter = iter(page_payload.segment_list or ())
+        firstSeg = list(islice(seg_iter, MAX_BIN_PER_REQUEST))
 
 
         # 初回送信分の作成（上限件数までバイナリデータセグメント埋め込みを行ったHTML作成）
         body_html, parts = _inject_first_segments(page_payload.body_html, firstSeg, name_prefix="p")
 
-        xhtml = f"""<!DOCTYPE html>
-        <html>
-        <head>
-        <title>{html.escape(page_payload.page_title)}</title>
-        </head>
-        <body>
-        {body_html}
-        </body>
-        </html>"""
+        # XHTMLは固定部分（エンコード済み）とタイトル・本文を1回で連結する（本文のエンコードは1回だけ）
+        xhtml = b"".join((
+            _XHTML_HEAD,
+            html.escape(page_payload.page_title).encode("utf-8"),
+            _XHTML_MID,
+            body_html.encode("utf-8"),
+            _XHTML_TAIL,
+        ))
 
         data_parts = {
-            "Presentation": ("presentation.html", xhtml.encode("utf-8"), "text/html"),
+            "Presentation": ("presentation.html", xhtml, "text/html"),
         }
         for part_name, bp in parts:
             data_parts[part_name] = (bp.filename, bp.data, bp.content_type)
 
+        # どのDXLのページかは冪等キー（source_key）でログに残す
+        # （client-request-id は送信ごとに _request_with_retry が新しく振る）
+        self._logger.info("Create page: title=%s source_key=%s", page_payload.page_title, page_payload.source_key)
+
         res = self._request_multipart("POST", url, data_parts=data_parts)
-        res.raise_for_status()
-        page = res.json()
+        page = _response_json(res)
         page_id = page["id"]
-
-        # # 残りがあれば PATCH で 5個ずつ埋めていく
-        # for off in range(0, len(restSeg), MAX_BIN_PER_REQUEST):
-        #     chunk = restSeg[off : off + MAX_BIN_PER_REQUEST]
-        #     self.update_onenote_page_segments(page_id=page_id, segments=chunk)
+        if on_created is not None:
+            on_created(page)
+
+        # 残りがあれば PATCH で 5個ずつ埋めていく（本文には data-id 付きの空divが残っている）
+        if self._patch_workers <= 1:
+            while chunk := list(islice(seg_iter, MAX_BIN_PER_REQUEST)):
+                self.update_onenote_page_segments(page_id=page_id, segments=chunk)
+            return page
+
+        # 各 PATCH は page_id と自分のアンカー（data-id）にしか依存しないので、まとめて並列に送る
+        chunks = list(iter(lambda: list(islice(seg_iter, MAX_BIN_PER_REQUEST)), []))
+        if len(chunks) == 1:
+            self.update_onenote_page_segments(page_id=page_id, segments=chunks[0])
+        elif chunks:
+            with ThreadPoolExecutor(max_workers=min(self._patch_workers, len(chunks))) as ex:
+                futures = [
+                    ex.submit(self.update_onenote_page_segments, page_id=page_id, segments=chunk)
+                    for chunk in chunks
+                ]
+                for f in futures:
+                    f.result()
 
         return page
@@ -0,0 +1,121 @@
+# graph_throttle.py
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+
+
+class AimdLimiter:
+    """
+    同時に送信するリクエスト数を AIMD で調整するリミッタ（スレッド間で共有）。
+
+    - 成功するたびに上限を少しずつ増やす（上限1件分の成功でおよそ +1）
+    - 429/503/5xx が返ったら上限を半分にする（最低1）
+    - max_limit を超えては増やさない
+    """
+
+    def __init__(self, max_limit: int, *, decrease: float = 0.5) -> None:
+        self._max = float(max_limit)
+        self._limit = float(max_limit)
+        self._decrease = decrease
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(1, int(self._limit))
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, *, throttled: bool) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self._limit = max(1.0, self._limit * self._decrease)
+            else:
+                self._limit = min(self._max, self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+
+class RequestRateWindow:
+    """
+    直近 period 秒の送信数を数え、limit 件に達していたら枠が空くまで待つ（スレッド間で共有）。
+    Graph のスロットリング（429）を受ける前に、こちら側で送信ペースを抑えるために使う。
+    """
+
+    def __init__(self, limit: int, *, period: float = 60.0) -> None:
+        self._limit = limit
+        self._period = period
+        self._sent: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def wait_turn(self) -> None:
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= self._period:
+                    self._sent.popleft()
+                if len(self._sent) < self._limit:
+                    self._sent.append(now)
+                    return
+                # 一番古い送信が窓から外れるまで待つ（待っている間は他スレッドも送れないので順番が保たれる）
+                time.sleep(self._period - (now - self._sent[0]))
+
+
+class AdaptiveTokenBucket:
+    """
+    送信レート（件/秒）を AIMD で調整するトークンバケット（スレッド間で共有）。
+
+    - acquire() はトークンが貯まるまで待ってから1つ消費する
+    - 成功したらレートを少し上げる（+increase、max_rate まで）
+    - 429/503 が返ったらレートを下げる（×decrease、min_rate まで）
+    - バーストは burst 件まで（しばらく送らなくても一度に大量には送らない）
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        *,
+        min_rate: float = 0.05,
+        max_rate: float = 10.0,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        burst: float = 1.0,
+    ) -> None:
+        self._rate = rate
+        self._min = min_rate
+        self._max = max_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def acquire(self) -> None:
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                time.sleep((1.0 - self._tokens) / self._rate)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._rate = min(self._max, self._rate + self._increase)
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            self._rate = max(self._min, self._rate * self._decrease)
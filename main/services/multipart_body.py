@@ -0,0 +1,148 @@
+# multipart_body.py
+from __future__ import annotations
+
+import io
+import os
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Mapping, Optional, Tuple, Union
+
+# パートの中身：メモリ上のバイト列 / ファイルパス / 読み出し可能なファイルオブジェクト
+PartContent = Union[bytes, bytearray, memoryview, Path, BinaryIO]
+MultipartPart = Tuple[str, PartContent, str]  # (filename, content, content_type)
+
+
+def _header_param(value: str) -> str:
+    """Content-Disposition のパラメータ値をエスケープする（HTML5方式、urllib3と同じ）。"""
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+class MultipartBody(io.RawIOBase):
+    """
+    multipart/form-data のボディを、読まれた分だけ組み立てて返すストリーム。
+
+    - bytes はそのまま、Path は送信時に開いて少しずつ読む（全体をメモリに載せない）
+    - 全体長は事前に計算するので Content-Length 付きで送れる
+    - seek(0) で先頭に戻せる（429/503 リトライ時の再送用）
+
+    requests には data= で渡し、Content-Type は content_type を使う。
+    """
+
+    def __init__(self, parts: Mapping[str, MultipartPart], *, boundary: Optional[str] = None) -> None:
+        super().__init__()
+        self.parts = parts  # ログ要約用に元の定義を保持
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+        # ボディを構成するチャンク（bytes / memoryview / Path / (ファイル, 開始位置)）
+        self._chunks: list[Union[bytes, memoryview, Path, Tuple[BinaryIO, int]]] = []
+        for name, (filename, content, content_type) in parts.items():
+            head = (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{_header_param(name)}"; '
+                f'filename="{_header_param(filename)}"\r\n'
+                f"Content-Type: {content_type}\r\n"
+                "\r\n"
+            ).encode("utf-8")
+            self._chunks.append(head)
+
+            if isinstance(content, Path):
+                self._chunks.append(content)
+            elif isinstance(content, bytes):
+                self._chunks.append(content)
+            elif isinstance(content, (bytearray, memoryview)):
+                # コピーせずにバイト単位のビューとして持つ
+                self._chunks.append(memoryview(content).cast("B"))
+            else:
+                self._chunks.append((content, content.tell()))
+
+            self._chunks.append(b"\r\n")
+        self._chunks.append(f"--{self.boundary}--\r\n".encode("ascii"))
+
+        self._length = sum(self._chunk_len(c) for c in self._chunks)
+
+        # 読み出し位置
+        self._pos = 0
+        self._idx = 0
+        self._offset = 0  # 現在チャンク内の位置（bytes チャンク用）
+        self._fh: Optional[BinaryIO] = None
+
+    @staticmethod
+    def _chunk_len(chunk: Union[bytes, memoryview, Path, Tuple[BinaryIO, int]]) -> int:
+        if isinstance(chunk, (bytes, memoryview)):
+            return len(chunk)
+        if isinstance(chunk, Path):
+            return chunk.stat().st_size
+        f, start = chunk
+        end = f.seek(0, os.SEEK_END)
+        f.seek(start)
+        return end - start
+
+    def __len__(self) -> int:
+        return self._length
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # 先頭への巻き戻しと現在位置の取得のみ対応（requests/リトライで使う範囲）
+        if whence == os.SEEK_CUR and offset == 0:
+            return self._pos
+        if whence != os.SEEK_SET or offset != 0:
+            raise io.UnsupportedOperation("MultipartBody only supports seek(0)")
+        self._close_current()
+        self._pos = 0
+        self._idx = 0
+        self._offset = 0
+        return 0
+
+    def _close_current(self) -> None:
+        # Path から開いたハンドルのみ閉じる（呼び出し側のファイルオブジェクトは閉じない）
+        if self._fh is not None and isinstance(self._chunks[self._idx], Path):
+            self._fh.close()
+        self._fh = None
+
+    def readinto(self, buf) -> int:  # type: ignore[override]
+        view = memoryview(buf).cast("B")
+        want = len(view)
+        written = 0
+
+        while written < want and self._idx < len(self._chunks):
+            chunk = self._chunks[self._idx]
+
+            if isinstance(chunk, (bytes, memoryview)):
+                n = min(want - written, len(chunk) - self._offset)
+                view[written : written + n] = chunk[self._offset : self._offset + n]
+                self._offset += n
+                written += n
+                if self._offset < len(chunk):
+                    break
+            else:
+                if self._fh is None:
+                    if isinstance(chunk, Path):
+                        self._fh = chunk.open("rb")
+                    else:
+                        self._fh, start = chunk
+                        self._fh.seek(start)
+                data = self._fh.read(want - written)
+                if data:
+                    view[written : written + len(data)] = data
+                    written += len(data)
+                    continue
+                self._close_current()
+
+            self._idx += 1
+            self._offset = 0
+
+        self._pos += written
+        return written
+
+    def close(self) -> None:
+        self._close_current()
+        super().close()
@@ -1,9 +1,24 @@
 # page_payload_builder.py
 from __future__ import annotations
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from main.services.dxl_to_page_material import create_materials_from_dxl
+from typing import Iterator, Sequence
+from main.services.dxl_to_page_material import create_materials_from_dxl, release_segment_files
 from main.services.renderer import render_to_html_body
-from main.models.models import PagePayload
+from main.services.upload_ledger import dxl_source_key
+from main.models.models import OneNoteRow, PagePayload
+from main.logging.logging_config import init_worker_logging, worker_logging_initargs
+
+# ページタイトルに使う項目（この順に "_" でつなぐ。値が無い項目は飛ばす）
+_TITLE_KEYS = ("DocumentNo", "Fd_Text_1")
+
+
+def _make_title(note: OneNoteRow, fallback: str) -> str:
+    """ページタイトル（ドキュメント番号_件名）を作る。どちらも無ければ fallback。"""
+    return "_".join(v for key in _TITLE_KEYS if (v := getattr(note, key))) or fallback
 
 
 def build_page_payload(
@@ -15,6 +30,8 @@ def build_page_payload(
     DXL1件を読み込み、OneNoteへ送るための情報を作る。
 
     戻り値: PagePayload
+    ※ segment_list の大きいバイナリは一時ファイル（Path）になっている。
+      送信後（失敗時も）に release_segment_files(payload.segment_list) で消すのは呼び出し側の責任。
     """
     base = dxl_path.name
     
@@ -22,7 +39,7 @@ def build_page_payload(
     note, segment_list = create_materials_from_dxl(str(dxl_path))
 
     # ページタイトル作成（ドキュメント番号_件名）
-    page_title = note.DocumentNo + "_" + note.Fd_Text_1
+    page_title = _make_title(note, dxl_path.stem)
 
     # 本文作成（HTML）
     body_html = render_to_html_body(note, source_file=base, row_no=row_no)
@@ -32,4 +49,55 @@ def build_page_payload(
         page_title = page_title,
         body_html =  body_html,
         segment_list =  segment_list,
+        source_key = dxl_source_key(dxl_path),
     )
+
+
+
+def _build_page_payload_job(dxl_path: Path, row_no: int) -> PagePayload:
+    """プロセスプール用（pickle可能なトップレベル関数である必要がある）"""
+    return build_page_payload(dxl_path, row_no=row_no)
+
+
+def build_page_payloads(
+    dxl_files: Sequence[Path],
+    *,
+    max_workers: int | None = None,
+) -> Iterator[PagePayload]:
+    """
+    複数DXLの PagePayload をプロセスプールで並列に作り、入力順に返す。
+
+    - DXL解析/base64デコード/HTML化はCPU処理なので、プロセスを分けてGILを避ける
+    - 呼び出し側がPOSTしている間も、先読み分のDXL変換が裏で進む
+    - 先読みは max_workers * 2 件までに抑える（変換済みPayloadを溜め込みすぎない）
+    - 返した Payload の一時ファイルは呼び出し側が release_segment_files で消す。
+      途中でやめる場合は close() を呼ぶと、先読みしたまま返していない分の一時ファイルをここで消す
+    """
+    workers = max_workers or os.cpu_count() or 1
+    jobs = iter(enumerate(dxl_files, start=1))
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker_logging,
+        initargs=worker_logging_initargs(),
+    ) as ex:
+        pending: deque[Future[PagePayload]] = deque(
+            ex.submit(_build_page_payload_job, path, row_no)
+            for row_no, path in islice(jobs, workers * 2)
+        )
+        try:
+            while pending:
+                future = pending.popleft()
+                for row_no, path in islice(jobs, 1):
+                    pending.append(ex.submit(_build_page_payload_job, path, row_no))
+                yield future.result()
+        finally:
+            # 呼び出し側の例外/close() で打ち切られたら、先読み分は未着手なら取り消し、変換済みなら一時ファイルを消す
+            for f in pending:
+                if f.cancel():
+                    continue
+                try:
+                    payload = f.result()
+                except Exception:
+                    continue
+                release_segment_files(payload.segment_list)
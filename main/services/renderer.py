@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import html
 import re
+from functools import lru_cache
 from typing import Optional
 
 from main.models.models import OneNoteRow
@@ -12,7 +13,10 @@ def _nl2br(s: Optional[str]) -> str:
     """プレーンテキストを安全に表示（escape + 改行を<br/>）。"""
     if not s:
         return ""
-    t = str(s).replace("\r\n", "\n").replace("\r", "\n")
+    t = str(s)
+    # CR を含まないテキスト（大半）は改行コードの正規化を省く
+    if "\r" in t:
+        t = t.replace("\r\n", "\n").replace("\r", "\n")
     return html.escape(t).replace("\n", "<br/>")
 
 
@@ -21,34 +25,48 @@ def _esc(s: Optional[str]) -> str:
     return "" if s is None else html.escape(str(s))
 
 
+# RichText 変換済みの HTML か（変換後は <p> / <div> で始まる。プレーンテキストのままの値と区別する）
+_HAS_HTML = re.compile(r"<(?:img|p|div)", re.IGNORECASE)
+
+
+def _as_html_or_text(s: Optional[str]) -> str:
+    """RichText フィールドの値を本文に入れる形にする（HTMLはそのまま、テキストは escape + 改行を<br/>）。"""
+    if not s:
+        return ""
+    return s if _HAS_HTML.search(s) else _nl2br(s)
+
+
 def _join_nonempty(*parts: Optional[str], sep: str = " ") -> str:
     """空文字を除外して結合"""
     xs = [str(p).strip() for p in parts if p is not None and str(p).strip()]
     return sep.join(xs)
 
 
+# Notes の日時表記（YYYYMMDD / THHMMSS / YYYYMMDDTHHMMSS、時刻の後ろに ,xx や +09 が付くことがある）
+# 3通りを1つのパターンにまとめ、1回の fullmatch でどれかを判定する
+_RE_NOTES_DT = re.compile(
+    r"(?P<date>\d{8})(?:T(?P<time>\d{6})(?:,\d+)?(?:[+-]\d{2})?)?"
+    r"|T(?P<tonly>\d{6})(?:,\d+)?(?:[+-]\d{2})?"
+)
+_RE_STARTS_DT = re.compile(r"\d{8}T")
+
+
 def _normalize_notes_dt(s: Optional[str]) -> str:
     """Notesの日時表記を人間が読みやすい形に整形。"""
     if not s:
         return ""
     t = str(s).strip()
 
-    m = re.fullmatch(r"(\d{4})(\d{2})(\d{2})", t)
-    if m:
-        return f"{m.group(1)}/{m.group(2)}/{m.group(3)}"
+    m = _RE_NOTES_DT.fullmatch(t)
+    if m is None:
+        return t
 
-    m = re.fullmatch(r"T(\d{2})(\d{2})(\d{2})(?:,\d+)?(?:[+-]\d{2})?", t)
-    if m:
-        return f"{m.group(1)}:{m.group(2)}:{m.group(3)}"
-
-    m = re.fullmatch(
-        r"(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})(\d{2})(?:,\d+)?(?:[+-]\d{2})?", t
-    )
-    if m:
-        y, mo, d, hh, mm, ss = m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6)
-        return f"{y}/{mo}/{d} {hh}:{mm}:{ss}"
-
-    return t
+    # 数字の位置は決まっているので、グループではなくスライスで組み立てる
+    if m["tonly"] is not None:
+        return f"{t[1:3]}:{t[3:5]}:{t[5:7]}"
+    if m["time"] is None:
+        return f"{t[:4]}/{t[4:6]}/{t[6:8]}"
+    return f"{t[:4]}/{t[4:6]}/{t[6:8]} {t[9:11]}:{t[11:13]}:{t[13:15]}"
 
 
 def _fmt_dt(date_s: Optional[str], time_s: Optional[str]) -> str:
@@ -56,7 +74,7 @@ def _fmt_dt(date_s: Optional[str], time_s: Optional[str]) -> str:
     time側に日付が入ってる（YYYYMMDDT...）場合は date側を無視して二重化を防ぐ。
     """
     t = (time_s or "").strip()
-    if re.match(r"^\d{8}T", t):
+    if _RE_STARTS_DT.match(t):
         return _normalize_notes_dt(t)
 
     d = _normalize_notes_dt(date_s)
@@ -64,18 +82,30 @@ def _fmt_dt(date_s: Optional[str], time_s: Optional[str]) -> str:
     return _join_nonempty(d, tt, sep=" ")
 
 
-def _kv_row(k: str, v_html: str) -> str:
-    """2カラムのテーブル行（左：キー／右：値HTML）。"""
+# 表の開始タグとページ全体を囲む div（ページごとに同じなので定数にしておく）
+_TABLE_OPEN = "<table style='width:100%; border-collapse:collapse;'>"
+_TABLE_CLOSE = "</table>"
+_CONTAINER_OPEN = "<div style='max-width:1100px; min-width:900px; margin:0 auto; padding:8px;'>"
+
+
+@lru_cache(maxsize=None)
+def _kv_head(k: str) -> str:
+    """_kv_row の値セルの手前まで（キーは固定の文字列なので、escape 済みの結果を使い回す）。"""
     return (
         "<tr>"
         f"<td style='width:180px; background:#f5f5f5; border:1px solid #ddd; padding:6px; vertical-align:top;'><b>{_esc(k)}</b></td>"
-        f"<td style='border:1px solid #ddd; padding:6px; vertical-align:top;'>{v_html}</td>"
-        "</tr>"
+        "<td style='border:1px solid #ddd; padding:6px; vertical-align:top;'>"
     )
 
 
+def _kv_row(k: str, v_html: str) -> str:
+    """2カラムのテーブル行（左：キー／右：値HTML）。"""
+    return f"{_kv_head(k)}{v_html}</td></tr>"
+
+
+@lru_cache(maxsize=None)
 def _section_title(title: str) -> str:
-    """セクションの見出し。"""
+    """セクションの見出し（見出しは固定の文字列なのでキャッシュする）。"""
     return (
         "<div style='margin-top:16px; padding:8px 10px; background:#eef6ff; border:1px solid #cfe6ff;'>"
         f"<b>{_esc(title)}</b>"
@@ -89,7 +119,6 @@ def render_to_html_body(
     source_file: str | None = None,
     row_no: int | None = None
 ) -> str:
-    container_start = "<div style='max-width:1100px; min-width:900px; margin:0 auto; padding:8px;'>"
     parts: list[str] = []
 
     def add_title(title: str) -> None:
@@ -105,18 +134,22 @@ def render_to_html_body(
     reporter2 = _join_nonempty(note.ReporterNm_2, note.ReporterDep_2)
     approver2 = _join_nonempty(note.ApproverNm_2, note.ApproverDep_2)
 
-    parts.append("<table style='width:100%; border-collapse:collapse;'>")
-    parts.append(_kv_row("発生報告", _nl2br(_join_nonempty(reporter1, _normalize_notes_dt(note.ReportTime_1), sep="\n"))))
-    parts.append(_kv_row("承認", _nl2br(_join_nonempty(approver1, _normalize_notes_dt(note.ApproveTime_1), note.ApproveStatus_1, sep="\n"))))
-    parts.append(_kv_row("完了報告", _nl2br(_join_nonempty(reporter2, _normalize_notes_dt(note.ReportTime_2), sep="\n"))))
-    parts.append(_kv_row("承認（完了）", _nl2br(_join_nonempty(approver2, _normalize_notes_dt(note.ApproveTime_2), note.ApproveStatus_2, sep="\n"))))
-    parts.append("</table>")
+    parts.extend((
+        _TABLE_OPEN,
+        _kv_row("発生報告", _nl2br(_join_nonempty(reporter1, _normalize_notes_dt(note.ReportTime_1), sep="\n"))),
+        _kv_row("承認", _nl2br(_join_nonempty(approver1, _normalize_notes_dt(note.ApproveTime_1), note.ApproveStatus_1, sep="\n"))),
+        _kv_row("完了報告", _nl2br(_join_nonempty(reporter2, _normalize_notes_dt(note.ReportTime_2), sep="\n"))),
+        _kv_row("承認（完了）", _nl2br(_join_nonempty(approver2, _normalize_notes_dt(note.ApproveTime_2), note.ApproveStatus_2, sep="\n"))),
+        _TABLE_CLOSE,
+    ))
 
     # --- 管理番号 ---
     add_title("管理番号")
-    parts.append("<table style='width:100%; border-collapse:collapse;'>")
-    parts.append(_kv_row("管理番号", f"<span style='font-size:16px; font-weight:bold;'>{_esc(note.DocumentNo)}</span>"))
-    parts.append("</table>")
+    parts.extend((
+        _TABLE_OPEN,
+        _kv_row("管理番号", f"<span style='font-size:16px; font-weight:bold;'>{_esc(note.DocumentNo)}</span>"),
+        _TABLE_CLOSE,
+    ))
 
     # --- 基本情報 ---
     add_title("基本情報")
@@ -125,17 +158,19 @@ def render_to_html_body(
     finished = _fmt_dt(note.ReplyDate, note.ReplyTime)
     work_time = (note.WorkTime or "").strip()
 
-    parts.append("<table style='width:100%; border-collapse:collapse;'>")
-    parts.append(_kv_row("入力者", _esc(entry_user)))
-    parts.append(_kv_row("分類", _nl2br(note.Syogai_ck)))
-    parts.append(_kv_row("システム", _esc(note.System)))
-    parts.append(_kv_row("サブシステム", _esc(note.SubSystem)))
-    parts.append(_kv_row("処理名", _esc(note.Task)))
-    parts.append(_kv_row("ステータス", _esc(note.ActionStatus)))
-    parts.append(_kv_row("開始日時", _esc(started)))
-    parts.append(_kv_row("完了日時", _esc(finished)))
-    parts.append(_kv_row("工数", _esc(work_time) + (" 分" if work_time else "")))
-    parts.append("</table>")
+    parts.extend((
+        _TABLE_OPEN,
+        _kv_row("入力者", _esc(entry_user)),
+        _kv_row("分類", _nl2br(note.Syogai_ck)),
+        _kv_row("システム", _esc(note.System)),
+        _kv_row("サブシステム", _esc(note.SubSystem)),
+        _kv_row("処理名", _esc(note.Task)),
+        _kv_row("ステータス", _esc(note.ActionStatus)),
+        _kv_row("開始日時", _esc(started)),
+        _kv_row("完了日時", _esc(finished)),
+        _kv_row("工数", _esc(work_time) + (" 分" if work_time else "")),
+        _TABLE_CLOSE,
+    ))
 
     # --- 件名 / 内容 ---
     add_title("件名 / 内容")
@@ -143,10 +178,10 @@ def render_to_html_body(
     add_text_block(note.Fd_Text_1)
 
     add_title("内容")
-    parts.append(note.Detail)
+    parts.append(_as_html_or_text(note.Detail))
 
     add_title("理由・原因")
-    parts.append(note.Reason)
+    parts.append(_as_html_or_text(note.Reason))
 
     add_title("対応（メモ）")
     add_text_block(note.Measure)
@@ -157,14 +192,14 @@ def render_to_html_body(
     add_text_block(note.Fd_Id_1)
 
     add_title("暫定策")
-    parts.append(note.Temporary)
+    parts.append(_as_html_or_text(note.Temporary))
     add_title("暫定策予定日付")
     add_text_block(note.Temporary_Plan)
     add_title("暫定策完了日付")
     add_text_block(note.Temporary_Comp)
 
     add_title("恒久策")
-    parts.append(note.Parmanent)
+    parts.append(_as_html_or_text(note.Parmanent))
     add_title("恒久策予定日付")
     add_text_block(note.Parmanet_Plan)
     add_title("恒久策完了日付")
@@ -173,7 +208,7 @@ def render_to_html_body(
     # --- Notesリンク ---
     add_title("Notesリンク")
     notes_links_li: list[str] = []
-    for s in (getattr(note, "notes_links", None) or []):
+    for s in note.notes_links:
         if "|" in s:
             desc, href = [x.strip() for x in s.split("|", 1)]
             notes_links_li.append(f"<li><a href='{_esc(href)}'>{_esc(desc)}</a></li>")
@@ -189,4 +224,4 @@ def render_to_html_body(
             "</div>"
         )
 
-    return container_start + "\n".join(parts) + "</div>"
+    return _CONTAINER_OPEN + "\n".join(parts) + "</div>"
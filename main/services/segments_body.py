@@ -1,33 +1,61 @@
 import re
 import html as _html
+from functools import lru_cache
 from main.models.models import Segment
 
+
+# 属性値用の escape（Content-Type・添付名など同じ値が繰り返し出るのでキャッシュする）
+# ※ 本文テキストのように値が毎回違うものには使わない
+# ※ パート名（p1..p5, u1..）はこちらで英数字だけで作るので escape しない
+_escape_attr = lru_cache(maxsize=1024)(_html.escape)
+
+
+def _image_style(width: int | None, height: int | None) -> str:
+    """img の style 属性値（文字列の継ぎ足しはせず1回で組み立てる）"""
+    return "".join((
+        "max-width:100%;",
+        f" width:{width}px;" if width else "",
+        f" height:{height}px;" if height else "",
+    ))
+
+
+# 画像/添付を囲む固定のHTML（呼び出しごとに組み立てない）
+_IMG_WRAP_OPEN = "<div style='margin:8px 0;'>"
+_ATT_WRAP_OPEN = (
+    "<div style='margin:8px 0; padding:10px; border:1px solid #e3e3e3; "
+    "border-radius:10px; background:#fff;'>"
+)
+_ATT_WRAP_OPEN_NO_BG = "<div style='margin:8px 0; padding:10px; border:1px solid #e3e3e3; border-radius:10px;'>"
+_WRAP_CLOSE = "</div>"
+
+
+def _img_tag(bp, part_name: str) -> str:
+    style = _image_style(bp.width, bp.height)
+    return f"<img src='name:{part_name}' style='{style}'/>"
+
+
+def _object_tag(bp, part_name: str) -> str:
+    fn = _escape_attr(bp.filename)
+    mt = _escape_attr(bp.content_type or "application/octet-stream")
+    return f"<object data='name:{part_name}' data-attachment='{fn}' type='{mt}'></object>"
+
+
 def _segment_to_html(seg: Segment, *, part_name: str) -> str:
 
     # 画像データのHTML変換
     if seg.binary_part.kind == "image":
-        style = "max-width:100%;"
-        if seg.binary_part.width:
-            style += f" width:{seg.binary_part.width}px;"
-        if seg.binary_part.height:
-            style += f" height:{seg.binary_part.height}px;"
-        return (
-            "<div style='margin:8px 0;'>"
-            f"<img src='name:{_html.escape(part_name, quote=True)}' style='{style}'/>"
-            "</div>"
-        )
+        return _IMG_WRAP_OPEN + _img_tag(seg.binary_part, part_name) + _WRAP_CLOSE
 
     # 添付ファイルデータのHTML変換
-    fn = _html.escape(seg.binary_part.filename, quote=True)
-    mt = _html.escape(seg.binary_part.content_type or "application/octet-stream", quote=True)
-    pn = _html.escape(part_name, quote=True)
-    return (
-        "<div style='margin:8px 0; padding:10px; border:1px solid #e3e3e3; "
-        "border-radius:10px; background:#fff;'>"
-        f"<object data='name:{pn}' data-attachment='{fn}' type='{mt}'></object>"
-        "</div>"
-    )
+    return _ATT_WRAP_OPEN + _object_tag(seg.binary_part, part_name) + _WRAP_CLOSE
+
+
 
+# data-id="..." を持つ空div（アンカー）。opentag の直後に中身を差し込む
+_EMPTY_ANCHOR_RE = re.compile(
+    r"(?P<opentag><div\b[^>]*\bdata-id=['\"](?P<segid>[^'\"]+)['\"][^>]*>)\s*</div>",
+    re.IGNORECASE,
+)
 
 
 def _inject_segments_into_body(body_html: str, seg_to_inner_html: dict[str, str]) -> str:
@@ -43,44 +71,19 @@ def _inject_segments_into_body(body_html: str, seg_to_inner_html: dict[str, str]
         return f"{open_tag}{inner}</div>"
 
     # data-id="..." を含む空divだけ対象にする
-    pattern = re.compile(
-        r"(?P<opentag><div\b[^>]*\bdata-id=['\"](?P<segid>[^'\"]+)['\"][^>]*>)\s*</div>",
-        re.IGNORECASE,
-    )
-    return pattern.sub(repl, body_html)
+    return _EMPTY_ANCHOR_RE.sub(repl, body_html)
 
 
 
-
-import html as _html
-
 def _segment_content_html(seg, part_name: str) -> str:
     bp = seg.binary_part
     if bp.kind == "image":
-        style = "max-width:100%;"
-        if bp.width:
-            style += f" width:{bp.width}px;"
-        if bp.height:
-            style += f" height:{bp.height}px;"
-        return f"<img src='name:{_html.escape(part_name, quote=True)}' style='{style}'/>"
+        return _img_tag(bp, part_name)
 
     # attachment
-    fn = _html.escape(bp.filename, quote=True)
-    mt = _html.escape(bp.content_type or "application/octet-stream", quote=True)
-    pn = _html.escape(part_name, quote=True)
-    return (
-        "<div style='margin:8px 0; padding:10px; border:1px solid #e3e3e3; border-radius:10px;'>"
-        f"<object data='name:{pn}' data-attachment='{fn}' type='{mt}'></object>"
-        "</div>"
-    )
-
-
-
-
+    return _ATT_WRAP_OPEN_NO_BG + _object_tag(bp, part_name) + _WRAP_CLOSE
 
 
-import re
-
 def _inject_first_segments(body_html: str, segments: list, name_prefix: str = "p") -> tuple[str, list[tuple[str, object]]]:
     """
     body_html 中の <div ... data-id='seg-001'></div> を
@@ -90,23 +93,28 @@ def _inject_first_segments(body_html: str, segments: list, name_prefix: str = "p
       - [(part_name, binary_part), ...]
     """
     parts: list[tuple[str, object]] = []
-    out = body_html
+    pending: dict[str, str] = {}  # segment_id -> 差し込むHTML
 
     for i, seg in enumerate(segments, start=1):
         part_name = f"{name_prefix}{i}"  # リクエスト内で一意なら何でもOK
-        content = _segment_content_html(seg, part_name)
+        pending[seg.segment_id] = _segment_content_html(seg, part_name)
         parts.append((part_name, seg.binary_part))
 
-        sid = re.escape(seg.segment_id)
-        # <div ... data-id="seg-001" ...></div> を、中身ありにする
-        pat = re.compile(
-            rf"(<div\b[^>]*\bdata-id=['\"]{sid}['\"][^>]*>)(\s*</div>)",
-            re.IGNORECASE,
-        )
-        out, n = pat.subn(rf"\1{content}\2", out, count=1)
-        # n==0 の場合：アンカーが無い（DXL→HTML 側の不整合）なのでログ出すのが吉
-
-    return out, parts
-
-
-
+    # セグメントごとに正規表現で本文全体を走査し直さず、アンカーを1回の走査で埋める
+    # （全部埋まったら残りは走査しない。アンカーが無いものは DXL→HTML 側の不整合なのでそのまま）
+    pieces: list[str] = []
+    pos = 0
+    if pending:
+        for m in _EMPTY_ANCHOR_RE.finditer(body_html):
+            content = pending.pop(m.group("segid"), None)
+            if content is None:
+                continue
+            end = m.end("opentag")
+            pieces.append(body_html[pos:end])
+            pieces.append(content)
+            pos = end
+            if not pending:
+                break
+    pieces.append(body_html[pos:])
+
+    return "".join(pieces), parts
@@ -35,7 +35,5 @@ def _build_update_multipart(self, segments: list) -> dict:
 def update_onenote_page_segments(self, *, page_id: str, segments: list) -> None:
     url = f"https://graph.microsoft.com/v1.0/me/onenote/pages/{quote(page_id)}/content"
     data_parts = self._build_update_multipart(segments)
-    r = self._request_multipart("PATCH", url, data_parts=data_parts)
-    # 成功は 204 :contentReference[oaicite:6]{index=6}
-    if r.status_code != 204:
-        r.raise_for_status()
+    # 成功は 204。4xx/5xx は _request_multipart（_request_with_retry）内で例外になる
+    self._request_multipart("PATCH", url, data_parts=data_parts)
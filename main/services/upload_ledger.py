@@ -0,0 +1,99 @@
+# upload_ledger.py
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def dxl_source_key(dxl_path: Path) -> str:
+    """
+    DXLファイルの中身から冪等キー（32桁の16進）を作る。
+    - 同じ内容のDXLは同じキーになる（ファイル名が変わっても再アップロードしない）
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with dxl_path.open("rb") as f:
+        # 大きいDXLも丸ごと読み込まず、1MBずつハッシュに通す
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class UploadLedger:
+    """
+    作成済みページの台帳（セクションID + 冪等キー → ページID, 完了したか）。
+
+    - 途中で失敗したバッチを再実行したとき、作成済みのDXLを再POSTしないために使う
+    - POST 直後に未完了（complete=False）で記録し、PATCH まで終わったら完了で記録し直す
+      （未完了のページは画像/添付が欠けているので、再実行時に作り直す）
+    - ファイルは JSON Lines の追記のみ（1件作成するたびに全体を書き直さない。同じキーは後の行が優先）
+    - 並列アップロードから呼ばれるのでスレッドセーフにしておく
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._pages: dict[tuple[str, str], tuple[str, bool]] = {}
+
+        try:
+            lines = path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            try:
+                rec = json.loads(line)
+                # complete が無い行は、完了後にだけ記録していた頃の形式
+                self._pages[(rec["section_id"], rec["key"])] = (rec["page_id"], bool(rec.get("complete", True)))
+            except (ValueError, KeyError, TypeError):
+                # 書き込み途中で止まった行などは読み飛ばす
+                logger.warning("Skip broken ledger line: %s", line[:200])
+
+    def get(self, section_id: str, key: Optional[str]) -> Optional[tuple[str, bool]]:
+        """記録があれば (ページID, 完了したか) を返す。"""
+        if not key:
+            return None
+        with self._lock:
+            return self._pages.get((section_id, key))
+
+    def record(
+        self,
+        section_id: str,
+        key: Optional[str],
+        page_id: str,
+        *,
+        source: str = "",
+        complete: bool = True,
+    ) -> None:
+        """ページの作成（complete=False）/ 完了を記録する（1行追記）。"""
+        if not key:
+            return
+        line = json.dumps(
+            {"section_id": section_id, "key": key, "page_id": page_id, "complete": complete, "source": source},
+            ensure_ascii=False,
+        )
+        with self._lock:
+            self._pages[(section_id, key)] = (page_id, complete)
+            with self._path.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def forget_section(self, section_id: str) -> None:
+        """セクションのページを全削除したときなど、そのセクションの記録を消す。"""
+        with self._lock:
+            before = len(self._pages)
+            self._pages = {k: v for k, v in self._pages.items() if k[0] != section_id}
+            if len(self._pages) == before:
+                return
+            tmp = self._path.with_name(self._path.name + ".tmp")
+            tmp.write_text(
+                "".join(
+                    json.dumps({"section_id": s, "key": k, "page_id": p, "complete": c}, ensure_ascii=False) + "\n"
+                    for (s, k), (p, c) in self._pages.items()
+                ),
+                encoding="utf-8",
+            )
+            tmp.replace(self._path)